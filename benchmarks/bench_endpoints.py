@@ -0,0 +1,277 @@
+"""Endpoint and hot-function benchmarks with a stored baseline.
+
+Every calculation route is driven in-process through an ASGI client with
+generated adult, pediatric (age < 19), burn and renal inputs. Each scenario
+reports p50/p95/p99 latency, requests/sec and peak traced allocation per
+request. Microbenchmarks time auto_renal_servings (uncached),
+auto_food_servings and calculate_pediatric_energy.
+
+Run from the repository root:
+
+    python benchmarks/bench_endpoints.py                    # compare to baseline
+    python benchmarks/bench_endpoints.py --update-baseline  # record a new baseline
+
+Every scenario runs --repeats times (default 5) and each metric is the
+median across the repeats, so one noisy run neither fails the gate nor ends
+up in the baseline. The run exits with status 1 when a p50/p95 latency
+grows, or throughput drops, by more than --threshold (default 50%) against
+the baseline.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import tracemalloc
+from time import perf_counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import httpx
+
+import main
+
+BASELINE_PATH = os.path.join(ROOT, "benchmarks", "baseline.json")
+HEADERS = {main.CACHE_BYPASS_HEADER: "1"}
+
+
+# Input generators
+
+def adult_input(rng):
+    return {
+        "age": rng.randint(19, 85),
+        "sex": rng.choice(["male", "female"]),
+        "weight": round(rng.uniform(45, 120), 1),
+        "height": round(rng.uniform(150, 195), 1),
+        "activity_factor": rng.choice([1.2, 1.3, 1.5]),
+        "stress_factor": rng.choice([1.0, 1.2, 1.4]),
+        "carbs_percent": 50,
+        "protein_percent": 20,
+        "fats_percent": 30,
+        "clinical_condition": rng.choice([None, "biguanides", "fast acting", "sulfonylureas"]),
+    }
+
+
+def pediatric_input(rng):
+    age = rng.randint(0, 18)
+    return dict(
+        adult_input(rng),
+        age=age,
+        weight=round(3.5 + age * 3.2 + rng.uniform(-1, 4), 1),
+        height=round(50 + age * 6.5 + rng.uniform(-4, 4), 1),
+        clinical_condition=None,
+    )
+
+
+def burn_input(rng):
+    return dict(
+        adult_input(rng),
+        clinical_condition="burn",
+        tbsa=round(rng.uniform(5, 70), 1),
+        body_temp=round(rng.uniform(36.5, 39.5), 1),
+        normal_daily_calories=rng.choice([1800, 2000, 2400]),
+    )
+
+
+def renal_input(rng):
+    return dict(
+        adult_input(rng),
+        carbs_percent=55,
+        protein_percent=15,
+        potassium_limit=rng.choice([1500, 2000, 2500, 3000]),
+        phosphate_limit=rng.choice([800, 1000, 1200]),
+        sodium_limit=rng.choice([1500, 2000, 2300]),
+    )
+
+
+SCENARIOS = [
+    # (name, path, input generator, patients per request)
+    ("metabolic_adult", "/calculate-normal-metabolic-diet", adult_input, 1),
+    ("metabolic_pediatric", "/calculate-normal-metabolic-diet", pediatric_input, 1),
+    ("metabolic_burn", "/calculate-normal-metabolic-diet", burn_input, 1),
+    ("normal_user_adult", "/calculate/normal_user", adult_input, 1),
+    ("dietitian_adult", "/calculate/dietitian", adult_input, 1),
+    ("dietitian_pediatric", "/calculate/dietitian", pediatric_input, 1),
+    ("dietitian_burn", "/calculate/dietitian", burn_input, 1),
+    ("renal_adult", "/calculate-renal-diet", renal_input, 1),
+    ("metabolic_batch_100", "/calculate-normal-metabolic-diet/batch", adult_input, 100),
+]
+
+
+def percentile(sorted_values, q):
+    index = min(len(sorted_values) - 1, max(0, round(q / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies, total_seconds):
+    latencies = sorted(latencies)
+    return {
+        "p50_ms": round(percentile(latencies, 50) * 1e3, 4),
+        "p95_ms": round(percentile(latencies, 95) * 1e3, 4),
+        "p99_ms": round(percentile(latencies, 99) * 1e3, 4),
+        "rps": round(len(latencies) / total_seconds, 1),
+    }
+
+
+async def run_scenario(client, path, generate, patients, requests, rng):
+    def body():
+        if patients == 1:
+            return generate(rng)
+        return [generate(rng) for _ in range(patients)]
+
+    for _ in range(min(50, requests)):  # warm up
+        (await client.post(path, json=body(), headers=HEADERS)).raise_for_status()
+
+    bodies = [body() for _ in range(requests)]
+    latencies = []
+    started = perf_counter()
+    for payload in bodies:
+        t = perf_counter()
+        response = await client.post(path, json=payload, headers=HEADERS)
+        latencies.append(perf_counter() - t)
+        response.raise_for_status()
+    result = summarize(latencies, perf_counter() - started)
+
+    # Allocation pass is separate: tracemalloc slows everything down
+    samples = bodies[:min(50, requests)]
+    peaks = []
+    tracemalloc.start()
+    for payload in samples:
+        tracemalloc.reset_peak()
+        current, _ = tracemalloc.get_traced_memory()
+        await client.post(path, json=payload, headers=HEADERS)
+        peaks.append(tracemalloc.get_traced_memory()[1] - current)
+    tracemalloc.stop()
+    result["alloc_kib_per_request"] = round(sum(peaks) / len(peaks) / 1024, 1)
+    return result
+
+
+def run_micro(fn, args_list, calls_per_sample=1):
+    # Sub-microsecond functions are timed in chunks so timer overhead doesn't dominate
+    latencies = []
+    started = perf_counter()
+    for i in range(0, len(args_list), calls_per_sample):
+        chunk = args_list[i:i + calls_per_sample]
+        t = perf_counter()
+        for args in chunk:
+            fn(*args)
+        latencies.append((perf_counter() - t) / len(chunk))
+    result = summarize(latencies, perf_counter() - started)
+    result["calls_per_s"] = round(len(args_list) / (perf_counter() - started), 1)
+    del result["rps"]
+    return result
+
+
+def micro_benchmarks(rng, calls):
+    def renal_uncached(*args):
+        main.cached_renal_allocation.cache_clear()
+        main.auto_renal_servings(*args)
+
+    renal_args = [
+        (rng.uniform(150, 400), rng.uniform(40, 130), rng.uniform(40, 110),
+         rng.choice([1500, 2000, 2500]), rng.choice([800, 1000, 1200]), rng.choice([1500, 2000, 2300]))
+        for _ in range(max(20, calls // 20))
+    ]
+    food_args = [(rng.uniform(100, 450), rng.uniform(30, 150), rng.uniform(30, 120)) for _ in range(calls)]
+    pediatric_args = [
+        (rng.randint(0, 18), rng.uniform(3, 70), rng.uniform(50, 180), rng.choice(["male", "female"]),
+         rng.choice([1.2, 1.3, 1.5]))
+        for _ in range(calls)
+    ]
+    return {
+        "micro_auto_renal_servings": run_micro(renal_uncached, renal_args),
+        "micro_auto_food_servings": run_micro(main.auto_food_servings, food_args, 100),
+        "micro_calculate_pediatric_energy": run_micro(main.calculate_pediatric_energy, pediatric_args, 100),
+    }
+
+
+async def run_all(args, rng):
+    results = {}
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for name, path, generate, patients in SCENARIOS:
+            if args.only and args.only not in name:
+                continue
+            requests = max(40, args.requests // patients * 2) if patients > 1 else args.requests
+            results[name] = await run_scenario(client, path, generate, patients, requests, rng)
+    if not args.only or "micro" in args.only:
+        results.update(micro_benchmarks(rng, args.requests * 100))
+    return results
+
+
+async def run_repeats(args):
+    # Later repeats draw fresh inputs from the same rng, so they don't just
+    # replay the menus cached by the first one
+    rng = random.Random(args.seed)
+    runs = []
+    for i in range(args.repeats):
+        print(f"repeat {i + 1}/{args.repeats}", file=sys.stderr)
+        runs.append(await run_all(args, rng))
+    return {
+        name: {metric: round(statistics.median(run[name][metric] for run in runs), 4) for metric in result}
+        for name, result in runs[0].items()
+    }
+
+
+def print_row(name, result):
+    rate = result.get("rps", result.get("calls_per_s"))
+    alloc = result.get("alloc_kib_per_request", "")
+    print(f"{name:<34}{result['p50_ms']:>10.3f}{result['p95_ms']:>10.3f}{result['p99_ms']:>10.3f}"
+          f"{rate:>12.1f}{alloc:>10}")
+
+
+def regressions(results, baseline, threshold):
+    failures = []
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if not reference:
+            continue
+        for metric in ("p50_ms", "p95_ms"):
+            if result[metric] > reference[metric] * (1 + threshold):
+                failures.append(f"{name}: {metric} {result[metric]} > baseline {reference[metric]}")
+        for metric in ("rps", "calls_per_s"):
+            if metric in result and result[metric] < reference[metric] * (1 - threshold):
+                failures.append(f"{name}: {metric} {result[metric]} < baseline {reference[metric]}")
+    return failures
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=300, help="requests per single-patient scenario")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=5, help="runs per scenario; the median is reported")
+    parser.add_argument("--only", help="run only scenarios whose name contains this text")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--threshold", type=float, default=0.5, help="allowed relative regression")
+    parser.add_argument("--update-baseline", action="store_true")
+    return parser.parse_args(argv)
+
+
+def run(argv=None):
+    args = parse_args(argv)
+    results = asyncio.run(run_repeats(args))
+    print(f"{'scenario':<34}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>12}{'KiB/req':>10}")
+    for name, result in results.items():
+        print_row(name, result)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Baseline written to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print("No baseline found; run with --update-baseline to record one.")
+        return 0
+    with open(args.baseline) as f:
+        failures = regressions(results, json.load(f), args.threshold)
+    for failure in failures:
+        print("REGRESSION", failure)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -0,0 +1,68 @@
+"""Serialization benchmark: FastAPI's default encoding path vs FastJSONResponse.
+
+Run from the repository root:
+
+    python benchmarks/bench_serialization.py
+"""
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+import main
+
+ADULT = {"age": 30, "sex": "male", "weight": 70, "height": 175, "activity_factor": 1.3,
+         "stress_factor": 1.2, "carbs_percent": 50, "protein_percent": 20, "fats_percent": 30}
+CASES = {
+    "adult": lambda: main.compute_diet(main.DietInput(**ADULT)),
+    "pediatric": lambda: main.compute_diet(main.DietInput(**dict(ADULT, age=8, weight=25, height=125))),
+    "burn": lambda: main.compute_diet(main.DietInput(**dict(ADULT, clinical_condition="burn", tbsa=35))),
+    "renal": lambda: main.compute_renal_diet(main.RenalDietInput(**ADULT)),
+    "batch_100": lambda: {"success": True, "message": "Batch calculation successful.", "count": 100,
+                          "results": main.compute_diet_batch([main.DietInput(**ADULT)] * 100)},
+}
+
+
+def default_body(result):
+    # What FastAPI does for a plain dict return value without a response_model
+    return JSONResponse(jsonable_encoder(result)).body
+
+
+def fast_body(result):
+    return main.FastJSONResponse(result).body
+
+
+def time_per_call(fn, result, number):
+    return min(timeit.repeat(lambda: fn(result), number=number, repeat=5)) / number
+
+
+def peak_bytes(fn, result):
+    tracemalloc.start()
+    fn(result)
+    tracemalloc.reset_peak()
+    fn(result)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def run():
+    main.FAST_JSON_RESPONSES = False
+    print(f"{'case':<12}{'default us':>12}{'fast us':>10}{'speedup':>9}{'default KiB':>13}{'fast KiB':>10}")
+    for name, build in CASES.items():
+        result = build()
+        assert default_body(result) == fast_body(result), name
+        number = 20 if name.startswith("batch") else 2000
+        slow = time_per_call(default_body, result, number)
+        fast = time_per_call(fast_body, result, number)
+        print(f"{name:<12}{slow * 1e6:>12.1f}{fast * 1e6:>10.1f}{slow / fast:>8.1f}x"
+              f"{peak_bytes(default_body, result) / 1024:>13.1f}{peak_bytes(fast_body, result) / 1024:>10.1f}")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,236 @@
+"""Concurrency load test: throughput and tail latency against a live server.
+
+Starts `uvicorn main:app` once per --workers value, then drives it from an
+asyncio client at each --concurrency level (closed loop: every simulated
+client sends its next request as soon as the previous one returns). Requests
+are spread over the four calculation routes with a --mix of normal, pediatric,
+burn and renal payloads; renal payloads go to /calculate-renal-diet, the others
+rotate over the three normal/metabolic routes. Result caching is bypassed
+unless --cache is given.
+
+Run from the repository root (uvicorn must be installed):
+
+    python benchmarks/load_test.py
+    python benchmarks/load_test.py --workers 1,2,4 --concurrency 1,8,32,128 --duration 15
+    python benchmarks/load_test.py --mix normal=1,renal=1 --output load.json
+    python benchmarks/load_test.py --url http://10.0.0.5:8000   # an already running server
+
+A level is marked "saturated" when it adds less than 10% throughput over the
+previous level while p99 latency still grows: past that point extra
+concurrency only queues. The client is a single process; when its CPU column
+nears 100% the generator, not the server, is the bottleneck.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from time import perf_counter
+
+import httpx
+
+from bench_endpoints import HEADERS, ROOT, adult_input, burn_input, pediatric_input, percentile, renal_input
+
+PAYLOADS = {
+    # kind: (input generator, routes it is sent to in rotation)
+    "normal": (adult_input, ["/calculate-normal-metabolic-diet", "/calculate/normal_user", "/calculate/dietitian"]),
+    "pediatric": (pediatric_input, ["/calculate-normal-metabolic-diet", "/calculate/normal_user", "/calculate/dietitian"]),
+    "burn": (burn_input, ["/calculate-normal-metabolic-diet", "/calculate/dietitian"]),
+    "renal": (renal_input, ["/calculate-renal-diet"]),
+}
+SATURATION_GAIN = 0.10  # throughput gain below which a level counts as saturated
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        if kind.strip() not in PAYLOADS:
+            raise argparse.ArgumentTypeError(f"unknown payload kind {kind!r}; use {', '.join(PAYLOADS)}")
+        mix[kind.strip()] = float(weight or 1)
+    return mix
+
+
+def parse_ints(text):
+    return [int(value) for value in text.split(",")]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(workers, port):
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning", "--no-access-log"],
+        cwd=ROOT,
+    )
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"uvicorn exited with status {process.returncode}")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/cache/stats", timeout=1).status_code == 200:
+                return process
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("uvicorn did not start within 60s")
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def request_plan(mix, count, rng):
+    # Pre-generated (path, body) pairs so payload generation isn't timed
+    kinds = list(mix)
+    turns = {kind: 0 for kind in kinds}
+    plan = []
+    for kind in rng.choices(kinds, weights=[mix[k] for k in kinds], k=count):
+        generate, routes = PAYLOADS[kind]
+        plan.append((routes[turns[kind] % len(routes)], json.dumps(generate(rng)).encode()))
+        turns[kind] += 1
+    return plan
+
+
+async def run_level(url, concurrency, duration, warmup, plan, headers):
+    latencies = []
+    errors = {}
+    state = {"next": 0, "recording": False}
+    headers = dict(headers, **{"content-type": "application/json"})
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        async def simulated_client(stop_at):
+            while time.monotonic() < stop_at:
+                path, body = plan[state["next"] % len(plan)]
+                state["next"] += 1
+                started = perf_counter()
+                try:
+                    response = await client.post(path, content=body, headers=headers)
+                    status = response.status_code
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                elapsed = perf_counter() - started
+                if state["recording"]:
+                    if status == 200:
+                        latencies.append(elapsed)
+                    else:
+                        errors[status] = errors.get(status, 0) + 1
+
+        stop_at = time.monotonic() + warmup + duration
+        tasks = [asyncio.create_task(simulated_client(stop_at)) for _ in range(concurrency)]
+        await asyncio.sleep(warmup)
+        state["recording"] = True
+        cpu, wall = time.process_time(), perf_counter()
+        await asyncio.gather(*tasks)
+        cpu, wall = time.process_time() - cpu, perf_counter() - wall
+
+    latencies.sort()
+    result = {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / wall, 1),
+        "client_cpu_pct": round(100 * cpu / wall, 1),
+    }
+    for q in (50, 95, 99):
+        result[f"p{q}_ms"] = round(percentile(latencies, q) * 1e3, 2) if latencies else None
+    result["max_ms"] = round(latencies[-1] * 1e3, 2) if latencies else None
+    return result
+
+
+def mark_saturation(levels):
+    for previous, level in zip(levels, levels[1:]):
+        gain = level["rps"] / previous["rps"] - 1 if previous["rps"] else 0
+        level["saturated"] = bool(
+            gain < SATURATION_GAIN and level["p99_ms"] is not None and previous["p99_ms"] is not None
+            and level["p99_ms"] > previous["p99_ms"]
+        )
+    if levels:
+        levels[0]["saturated"] = False
+    return levels
+
+
+def print_header(label):
+    print(f"\n{label}")
+    print(f"{'conc':>6}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+          f"{'errors':>8}{'client CPU':>12}")
+
+
+def print_level(level):
+    def ms(value):
+        return f"{value:>10.2f}" if value is not None else f"{'-':>10}"
+
+    errors = sum(level["errors"].values())
+    flag = "  saturated" if level["saturated"] else ""
+    print(f"{level['concurrency']:>6}{level['rps']:>10.1f}{ms(level['p50_ms'])}{ms(level['p95_ms'])}"
+          f"{ms(level['p99_ms'])}{ms(level['max_ms'])}{errors:>8}{level['client_cpu_pct']:>11.1f}%{flag}")
+
+
+async def run_series(url, args, plan):
+    levels = []
+    for concurrency in args.concurrency:
+        levels.append(await run_level(url, concurrency, args.duration, args.warmup, plan, args.headers))
+        mark_saturation(levels)
+        print_level(levels[-1])
+    return levels
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=parse_ints, default=[1, 2], help="uvicorn worker counts, e.g. 1,2,4")
+    parser.add_argument("--concurrency", type=parse_ints, default=[1, 4, 16, 64],
+                        help="concurrent clients per level, e.g. 1,8,32")
+    parser.add_argument("--duration", type=float, default=10, help="measured seconds per level")
+    parser.add_argument("--warmup", type=float, default=2, help="unmeasured seconds before each level")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("normal=4,pediatric=2,burn=1,renal=3"),
+                        help="payload weights, e.g. normal=4,pediatric=2,burn=1,renal=3")
+    parser.add_argument("--cache", action="store_true", help="let the server's result cache answer repeats")
+    parser.add_argument("--url", help="test this running server instead of starting uvicorn")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="also write the report as JSON to this file")
+    args = parser.parse_args(argv)
+    args.headers = {} if args.cache else HEADERS
+    return args
+
+
+def run(argv=None):
+    args = parse_args(argv)
+    plan = request_plan(args.mix, 5000, random.Random(args.seed))
+    report = {"mix": args.mix, "duration_s": args.duration, "cache": args.cache, "runs": []}
+    if args.url:
+        print_header(f"server {args.url}")
+        report["runs"].append({"url": args.url, "levels": asyncio.run(run_series(args.url, args, plan))})
+    for workers in [] if args.url else args.workers:
+        port = free_port()
+        server = start_server(workers, port)
+        try:
+            print_header(f"uvicorn --workers {workers} (server CPUs: {os.cpu_count()})")
+            levels = asyncio.run(run_series(f"http://127.0.0.1:{port}", args, plan))
+        finally:
+            stop_server(server)
+        report["runs"].append({"workers": workers, "levels": levels})
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+        print(f"\nReport written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -1,20 +1,57 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 from typing import Optional
 from fastapi import Body
+from fastapi import Query
 from typing import Dict
 from fastapi import Request
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from typing import List
+from typing import Union
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from time import monotonic, perf_counter, time
+import ast
+import asyncio
+import cProfile
+import csv
+import gzip
+import hashlib
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import queue
+import random
+import sqlite3
+import threading
+import uuid
+import numpy as np
 
-app = FastAPI()
+# Startup/shutdown work registered by the sections below
+STARTUP_HOOKS = []
+SHUTDOWN_HOOKS = []
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+@asynccontextmanager
+async def lifespan(app):
+    for hook in STARTUP_HOOKS:
+        hook()
+    yield
+    for hook in SHUTDOWN_HOOKS:
+        hook()
+
+app = FastAPI(lifespan=lifespan)
 
 class DietInput(BaseModel):
     age: int
@@ -143,20 +180,54 @@ RENAL_PORTION_REFERENCES = {
     "pdf_link": "https://drive.google.com/file/d/1f7hKLphgVfiBsMwks534DlJlmQLV827E/view?usp=drivesdk"
 }
 
-def calculate_food_exchanges(servings_dict):
+# Array-backed food group tables: groups x FOOD_COLUMNS, per serving.
+# Exchanges, totals and residuals for both the normal and renal paths come
+# from servings-vector x matrix products; dicts are only built at the edge.
+FOOD_COLUMNS = ("carb", "protein", "fat", "kcal", "k", "na", "po4")
+EXCHANGE_FIELDS = ("carbs_g", "protein_g", "fats_g", "calories", "k_mg", "na_mg", "po4_mg")
+NORMAL_EXCHANGE_FIELDS = 4  # normal groups carry no electrolyte data
+
+FOOD_GROUP_NAMES = [g["name"] for g in FOOD_GROUPS]
+FOOD_GROUP_MATRIX = np.array([
+    [g["carb_per_serv"], g["protein_per_serv"], g["fat_per_serv"], g["calories_per_serv"], 0, 0, 0]
+    for g in FOOD_GROUPS
+], dtype=np.int64)
+
+RENAL_FOOD_GROUP_NAMES = [g["name"] for g in RENAL_FOOD_GROUPS]
+RENAL_FOOD_GROUP_MATRIX = np.array([
+    [g["carb"], g["protein"], g["fat"], g["cal"], g["k"], g["na"], g["po4"]]
+    for g in RENAL_FOOD_GROUPS
+], dtype=np.int64)
+
+def servings_vector(servings_dict, names):
+    return np.array([servings_dict.get(name, 0) for name in names], dtype=np.int64)
+
+def compute_exchanges(servings, matrix):
+    # servings (..., groups) -> per-group amounts (..., groups, columns), totals (..., columns)
+    return servings[..., :, None] * matrix, servings @ matrix
+
+def exchange_dict(names, servings, per_group, fields):
+    # Edge conversion to the response shape; servings/per_group are plain lists
+    keys = EXCHANGE_FIELDS[:fields]
     exchanges = {}
-    for group in FOOD_GROUPS:
-        name = group["name"]
-        servings = servings_dict.get(name, 0)
-        exchanges[name] = {
-            "servings": servings,
-            "carbs_g": servings * group["carb_per_serv"],
-            "protein_g": servings * group["protein_per_serv"],
-            "fats_g": servings * group["fat_per_serv"],
-            "calories": servings * group["calories_per_serv"]
-        }
+    for name, s, amounts in zip(names, servings, per_group):
+        exchange = {"servings": s}
+        exchange.update(zip(keys, amounts))
+        exchanges[name] = exchange
     return exchanges
 
+def macro_residuals(carbs_g, protein_g, fats_g, totals):
+    return {
+        "carbs_g": round(carbs_g - totals[0], 2),
+        "protein_g": round(protein_g - totals[1], 2),
+        "fats_g": round(fats_g - totals[2], 2)
+    }
+
+def calculate_food_exchanges(servings_dict):
+    servings = servings_vector(servings_dict, FOOD_GROUP_NAMES)
+    per_group, _ = compute_exchanges(servings, FOOD_GROUP_MATRIX)
+    return exchange_dict(FOOD_GROUP_NAMES, servings.tolist(), per_group.tolist(), NORMAL_EXCHANGE_FIELDS)
+
 # Diabetes medication meal carb distribution
 MEDICATION_CARB_DISTRIBUTION = {
     "sulfonylureas": [0.3, 0.0, 0.3, 0.0, 0.3, 0.1],  # BF, MMS, Lunch, AS, Dinner, LNS
@@ -181,6 +252,12 @@ def calculate_meal_distribution(total_carbs, medication_type):
         meal_dist[meal] = round(total_carbs * distribution[i], 2)
     return meal_dist
 
+def calculate_bmr(sex, weight, height, age):
+    # Harris-Benedict
+    if sex.lower() == 'male':
+        return 66.5 + (13.75 * weight) + (5.003 * height) - (6.75 * age)
+    return 655.1 + (9.563 * weight) + (1.85 * height) - (4.676 * age)
+
 def calculate_fluid_requirement(weight_kg):
     if weight_kg <= 10:
         return weight_kg * 100
@@ -305,7 +382,35 @@ PORTION_REFERENCES = {
     ]
 }
 
-def auto_renal_servings(carbs_g, protein_g, fats_g, k_limit, po4_limit, na_limit):
+# Static meal plan example, returned when no food database is available
+MEAL_PLAN_EXAMPLE = {
+    "breakfast": [
+        {"food": "Oats", "quantity": "1 cup"},
+        {"food": "Milk", "quantity": "1 glass"}
+    ],
+    "lunch": [
+        {"food": "Rice", "quantity": "1 cup"},
+        {"food": "Chicken", "quantity": "100g"},
+        {"food": "Vegetables", "quantity": "1 cup"}
+    ],
+    "dinner": [
+        {"food": "Sweet Potato", "quantity": "1 cup"},
+        {"food": "Fish", "quantity": "100g"},
+        {"food": "Salad", "quantity": "1 cup"}
+    ],
+    "snacks": [
+        {"food": "Apple", "quantity": "1"},
+        {"food": "Almonds", "quantity": "10 pieces"}
+    ]
+}
+
+RENAL_MAX_SERVINGS = 10  # per food group per day
+RENAL_SOLVER_TIME_BUDGET = 0.05  # seconds per allocation
+RENAL_ALLOCATION_CACHE_SIZE = 4096
+RENAL_MACROS = ("carb", "protein", "fat")
+RENAL_ELECTROLYTES = ("k", "po4", "na")
+
+def greedy_renal_servings(carbs_g, protein_g, fats_g, k_limit, po4_limit, na_limit):
     # Simple greedy allocation: prioritize low K/PO4 groups, fill macros, don't exceed limits
     servings = {g["name"]: 0 for g in RENAL_FOOD_GROUPS}
     macros = {"carb": carbs_g, "protein": protein_g, "fat": fats_g}
@@ -314,11 +419,11 @@ def auto_renal_servings(carbs_g, protein_g, fats_g, k_limit, po4_limit, na_limit
     for g in RENAL_FOOD_GROUPS:
         max_serv = 0
         if g["carb"] > 0:
-            max_serv = min(macros["carb"] // g["carb"], 10)
+            max_serv = min(macros["carb"] // g["carb"], RENAL_MAX_SERVINGS)
         elif g["protein"] > 0:
-            max_serv = min(macros["protein"] // g["protein"], 10)
+            max_serv = min(macros["protein"] // g["protein"], RENAL_MAX_SERVINGS)
         elif g["fat"] > 0:
-            max_serv = min(macros["fat"] // g["fat"], 10)
+            max_serv = min(macros["fat"] // g["fat"], RENAL_MAX_SERVINGS)
         max_serv = int(max_serv)
         for _ in range(max_serv):
             # Check if adding this serving would exceed any electrolyte limit
@@ -333,8 +438,1560 @@ def auto_renal_servings(carbs_g, protein_g, fats_g, k_limit, po4_limit, na_limit
             electrolytes["na"] += g["na"]
     return servings, electrolytes
 
-@app.post("/calculate-normal-metabolic-diet")
-def calculate_diet(input: DietInput):
+def build_renal_search_plan(groups):
+    # Electrolyte-free single-macro groups (sugar, fats) are "fillers": their best
+    # count is closed-form at each leaf. The others are searched, multi-macro
+    # groups first and, within one macro profile, cheaper electrolytes first.
+    fillers = {}
+    searched = []
+    for i, g in enumerate(groups):
+        macros = [m for m in range(3) if g[RENAL_MACROS[m]] > 0]
+        if len(macros) == 1 and macros[0] not in fillers and not any(g[e] for e in RENAL_ELECTROLYTES):
+            fillers[macros[0]] = i
+        else:
+            searched.append(i)
+    searched.sort(key=lambda i: (
+        -sum(1 for m in RENAL_MACROS if groups[i][m] > 0),
+        -sum(groups[i][m] for m in RENAL_MACROS),
+        tuple(groups[i][m] for m in RENAL_MACROS),
+        sum(groups[i][e] for e in RENAL_ELECTROLYTES),
+    ))
+    # A group with the same macros as an earlier group but no lower electrolytes
+    # is only worth using once that earlier group is at the serving cap.
+    dominators = {}
+    for pos, i in enumerate(searched):
+        dominators[i] = [
+            j for j in searched[:pos]
+            if all(groups[j][m] == groups[i][m] for m in RENAL_MACROS)
+            and all(groups[j][e] <= groups[i][e] for e in RENAL_ELECTROLYTES)
+        ]
+    # Most of each macro still reachable from search position pos onwards
+    remaining = []
+    for pos in range(len(searched) + 1):
+        reach = [0, 0, 0]
+        for i in list(searched[pos:]) + list(fillers.values()):
+            for m in range(3):
+                reach[m] += RENAL_MAX_SERVINGS * groups[i][RENAL_MACROS[m]]
+        remaining.append(reach)
+    return {"order": searched, "fillers": fillers, "dominators": dominators, "remaining": remaining}
+
+RENAL_SEARCH_PLAN = build_renal_search_plan(RENAL_FOOD_GROUPS)
+# Per-group (carb, protein, fat, k, po4, na) rows of RENAL_FOOD_GROUP_MATRIX for the solver
+RENAL_SOLVER_GROUPS = [
+    tuple(row) for row in RENAL_FOOD_GROUP_MATRIX[:, [
+        FOOD_COLUMNS.index(column) for column in RENAL_MACROS + RENAL_ELECTROLYTES
+    ]].tolist()
+]
+
+def refine_renal_servings(counts, carbs_g, protein_g, fats_g, k_limit, po4_limit, na_limit):
+    # Local search: apply single-serving add/remove/swap moves while they lower
+    # the summed absolute macro residual and stay within the electrolyte limits.
+    groups = RENAL_SOLVER_GROUPS
+    target = (carbs_g, protein_g, fats_g)
+    limits = tuple(float("inf") if v is None else v for v in (k_limit, po4_limit, na_limit))
+    counts = list(counts)
+    totals = [sum(s * g[x] for s, g in zip(counts, groups)) for x in range(6)]
+
+    def score(delta):
+        return sum(abs(target[m] - totals[m] - delta[m]) for m in range(3))
+
+    def fits(delta):
+        return all(totals[3 + e] + delta[3 + e] <= limits[e] for e in range(3))
+
+    n = len(groups)
+    current = score((0, 0, 0))
+    improved = True
+    while improved:
+        improved = False
+        for i in range(n):
+            for j in [None] + list(range(n)):
+                # Move: add a serving of i (and remove one of j, if given)
+                if j == i or counts[i] >= RENAL_MAX_SERVINGS or (j is not None and counts[j] == 0):
+                    continue
+                delta = [groups[i][x] - (groups[j][x] if j is not None else 0) for x in range(6)]
+                candidate = score(delta)
+                if candidate < current and fits(delta):
+                    counts[i] += 1
+                    if j is not None:
+                        counts[j] -= 1
+                    totals = [totals[x] + delta[x] for x in range(6)]
+                    current = candidate
+                    improved = True
+            if counts[i] > 0:
+                delta = [-groups[i][x] for x in range(6)]
+                candidate = score(delta)
+                if candidate < current:
+                    counts[i] -= 1
+                    totals = [totals[x] + delta[x] for x in range(6)]
+                    current = candidate
+                    improved = True
+    return counts
+
+def solve_renal_servings(carbs_g, protein_g, fats_g, k_limit, po4_limit, na_limit,
+                         time_budget=RENAL_SOLVER_TIME_BUDGET):
+    # Branch-and-bound over integer servings: minimise the summed absolute macro
+    # residual (g) subject to the K/PO4/Na limits. Seeded with the refined
+    # greedy allocation; returns the best allocation found within time_budget.
+    groups = RENAL_SOLVER_GROUPS
+    order = RENAL_SEARCH_PLAN["order"]
+    fillers = RENAL_SEARCH_PLAN["fillers"]
+    dominators = RENAL_SEARCH_PLAN["dominators"]
+    remaining = RENAL_SEARCH_PLAN["remaining"]
+    cap = RENAL_MAX_SERVINGS
+    target = (carbs_g, protein_g, fats_g)
+    limits = tuple(float("inf") if v is None else v for v in (k_limit, po4_limit, na_limit))
+
+    def residual(achieved):
+        return sum(abs(target[m] - achieved[m]) for m in range(3))
+
+    greedy, _ = greedy_renal_servings(carbs_g, protein_g, fats_g, *limits)
+    counts = refine_renal_servings(
+        [greedy[g["name"]] for g in RENAL_FOOD_GROUPS], carbs_g, protein_g, fats_g, *limits
+    )
+    best = {
+        "residual": residual([sum(s * g[m] for s, g in zip(counts, groups)) for m in range(3)]),
+        "counts": counts,
+    }
+    counts = [0] * len(groups)
+    deadline = perf_counter() + time_budget
+    state = {"nodes": 0, "expired": False}
+
+    def search(pos, achieved, used):
+        state["nodes"] += 1
+        if state["nodes"] & 1023 == 0 and perf_counter() > deadline:
+            state["expired"] = True
+        if state["expired"]:
+            return
+        # Lower bound: overshoot can't be undone, shortfall beyond reach can't be
+        # closed, and whole-gram servings can't hit a fractional target exactly.
+        reach = list(remaining[pos])
+        # Electrolyte headroom may cap a remaining group below RENAL_MAX_SERVINGS
+        for i in order[pos:]:
+            g = groups[i]
+            top = cap
+            for e in range(3):
+                if g[3 + e] and limits[e] - used[e] < top * g[3 + e]:
+                    top = int((limits[e] - used[e]) // g[3 + e])
+            if top < cap:
+                for m in range(3):
+                    reach[m] -= (cap - max(top, 0)) * g[m]
+        bound = 0
+        for m in range(3):
+            need = target[m] - achieved[m]
+            if need < 0:
+                bound -= need
+            elif need > reach[m]:
+                bound += need - reach[m]
+            else:
+                bound += abs(need - round(need))
+        if bound >= best["residual"]:
+            return
+        if pos == len(order):
+            final = list(achieved)
+            for m, i in fillers.items():
+                per_serv = groups[i][m]
+                counts[i] = min(cap, max(0, round((target[m] - final[m]) / per_serv)))
+                final[m] += counts[i] * per_serv
+            score = residual(final)
+            if score < best["residual"]:
+                best["residual"] = score
+                best["counts"] = list(counts)
+            return
+        i = order[pos]
+        g = groups[i]
+        top = cap
+        if any(counts[j] < cap for j in dominators[i]):
+            top = 0
+        for e in range(3):
+            if g[3 + e] and limits[e] != float("inf"):
+                top = min(top, int((limits[e] - used[e]) // g[3 + e]))
+        for m in range(3):
+            if g[m]:
+                # Overshooting a macro by more than the incumbent residual can't win
+                top = min(top, int((target[m] - achieved[m] + best["residual"]) // g[m]))
+        for s in range(max(top, 0), -1, -1):
+            counts[i] = s
+            search(
+                pos + 1,
+                (achieved[0] + s * g[0], achieved[1] + s * g[1], achieved[2] + s * g[2]),
+                (used[0] + s * g[3], used[1] + s * g[4], used[2] + s * g[5]),
+            )
+        counts[i] = 0
+
+    search(0, (0, 0, 0), (0, 0, 0))
+    return best["counts"]
+
+# Renal feasibility index
+# Renal prescriptions mostly use a few standard K/PO4/Na tiers. For every tier
+# and banded macro target, the index file (DIET_RENAL_INDEX, default
+# data/renal_index.npz) holds the solver's serving vector, so an uncached
+# tiered prescription costs one array lookup plus refine_renal_servings from
+# the nearest band instead of a full solve. Off-tier limits and out-of-range
+# targets use the live solver. The file records the group table and serving
+# cap it was solved for and is ignored once those change; rebuild it with
+# scripts/build_renal_index.py.
+RENAL_INDEX_PATH = os.environ.get(
+    "DIET_RENAL_INDEX", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "renal_index.npz")
+)
+RENAL_INDEX_TIERS = {"k": (1500, 2000, 2500, 3000), "po4": (800, 1000, 1200), "na": (1500, 2000, 2300)}  # mg/day
+RENAL_INDEX_BANDS = {"carb": (100, 450, 25), "protein": (30, 150, 15), "fat": (30, 120, 15)}  # start, stop, step (g)
+RENAL_INDEX_CANDIDATES = 2  # band corners refined per lookup
+
+def renal_index_axes():
+    return [np.arange(start, stop + step, step) for start, stop, step in RENAL_INDEX_BANDS.values()]
+
+def solve_renal_index_tier(k_limit, po4_limit, na_limit, axes, time_budget):
+    # (carb bands x protein bands x fat bands x groups) servings for one tier
+    carbs, protein, fats = axes
+    counts = np.zeros((len(carbs), len(protein), len(fats), len(RENAL_FOOD_GROUPS)), dtype=np.int8)
+    for a, carbs_g in enumerate(carbs.tolist()):
+        for b, protein_g in enumerate(protein.tolist()):
+            for c, fats_g in enumerate(fats.tolist()):
+                counts[a, b, c] = solve_renal_servings(
+                    carbs_g, protein_g, fats_g, k_limit, po4_limit, na_limit, time_budget
+                )
+    return counts
+
+def build_renal_index(path, time_budget=RENAL_SOLVER_TIME_BUDGET, processes=None):
+    # Offline: solve every tier x band (one tier per pool task) and write the index file
+    tiers = list(itertools.product(*RENAL_INDEX_TIERS.values()))
+    axes = renal_index_axes()
+    pool = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("spawn"))
+    with pool:
+        solved = list(pool.map(
+            solve_renal_index_tier, *zip(*tiers), [axes] * len(tiers), [time_budget] * len(tiers)
+        ))
+    shape = tuple(len(values) for values in RENAL_INDEX_TIERS.values())
+    carbs, protein, fats = axes
+    np.savez_compressed(
+        path,
+        counts=np.stack(solved).reshape(shape + solved[0].shape),
+        groups=np.array(RENAL_SOLVER_GROUPS),
+        max_servings=RENAL_MAX_SERVINGS,
+        k=RENAL_INDEX_TIERS["k"], po4=RENAL_INDEX_TIERS["po4"], na=RENAL_INDEX_TIERS["na"],
+        carb=carbs, protein=protein, fat=fats
+    )
+
+class RenalIndex:
+    def __init__(self, path):
+        with np.load(path) as index:
+            self.counts = index["counts"]
+            self.groups = index["groups"]
+            self.max_servings = int(index["max_servings"])
+            # limit (mg) -> position, per electrolyte
+            self.tiers = [{v: i for i, v in enumerate(index[e].tolist())} for e in RENAL_ELECTROLYTES]
+            # (first band, band step, band count) per macro
+            self.bands = [
+                (float(index[m][0]), float(index[m][1] - index[m][0]), len(index[m])) for m in RENAL_MACROS
+            ]
+
+    def current(self):
+        return self.max_servings == RENAL_MAX_SERVINGS and np.array_equal(self.groups, RENAL_SOLVER_GROUPS)
+
+    def lookup(self, carbs_g, protein_g, fats_g, k_limit, po4_limit, na_limit):
+        # Serving vectors of the (up to 8) band corners around the target for
+        # this tier, or None off the grid
+        tier = []
+        for tiers, limit in zip(self.tiers, (k_limit, po4_limit, na_limit)):
+            if limit not in tiers:
+                return None
+            tier.append(tiers[limit])
+        bands = []
+        for (start, step, count), target in zip(self.bands, (carbs_g, protein_g, fats_g)):
+            position = (target - start) / step
+            if not -0.5 <= position <= count - 0.5:
+                return None
+            low = min(max(int(position // 1), 0), count - 1)
+            bands.append(sorted({low, min(low + 1, count - 1)}))
+        return [self.counts[tuple(tier) + corner].tolist() for corner in itertools.product(*bands)]
+
+def load_renal_index(path):
+    if not os.path.exists(path):
+        return None
+    index = RenalIndex(path)
+    return index if index.current() else None
+
+RENAL_INDEX = load_renal_index(RENAL_INDEX_PATH)
+
+def indexed_renal_allocation(carbs_g, protein_g, fats_g, k_limit, po4_limit, na_limit):
+    if RENAL_INDEX is None:
+        return None
+    corners = RENAL_INDEX.lookup(carbs_g, protein_g, fats_g, k_limit, po4_limit, na_limit)
+    if corners is None:
+        return None
+    groups = RENAL_SOLVER_GROUPS
+    target = (carbs_g, protein_g, fats_g)
+
+    def residual(counts):
+        return sum(abs(target[m] - sum(s * g[m] for s, g in zip(counts, groups))) for m in range(3))
+
+    # Stored vectors fit this tier's limits and refinement only moves within
+    # them. Refining the two closest corners matches the live solver's residual
+    # on average at a fraction of its time.
+    corners.sort(key=residual)
+    refined = [
+        refine_renal_servings(counts, carbs_g, protein_g, fats_g, k_limit, po4_limit, na_limit)
+        for counts in corners[:RENAL_INDEX_CANDIDATES]
+    ]
+    return min(refined, key=residual)
+
+@lru_cache(maxsize=RENAL_ALLOCATION_CACHE_SIZE)
+def cached_renal_allocation(carbs_g, protein_g, fats_g, k_limit, po4_limit, na_limit):
+    # Backed by the shared cache, so workers don't each re-solve the same prescriptions
+    key = (carbs_g, protein_g, fats_g, k_limit, po4_limit, na_limit)
+    shared = shared_cache()
+    if shared is not None:
+        counts = shared.get(key, "renal_allocation")
+        if counts is not None:
+            return tuple(counts)
+    counts = indexed_renal_allocation(carbs_g, protein_g, fats_g, k_limit, po4_limit, na_limit)
+    if counts is None:
+        counts = solve_renal_servings(carbs_g, protein_g, fats_g, k_limit, po4_limit, na_limit)
+    counts = tuple(counts)
+    if shared is not None:
+        shared.put(key, counts, "renal_allocation")
+    return counts
+
+def auto_renal_servings(carbs_g, protein_g, fats_g, k_limit, po4_limit, na_limit):
+    # Targets are rounded to whole g / mg so common prescriptions share cache
+    # entries; limits are rounded down so the allocation never exceeds them
+    counts = cached_renal_allocation(
+        round(carbs_g), round(protein_g), round(fats_g),
+        *(None if v is None else math.floor(v) for v in (k_limit, po4_limit, na_limit))
+    )
+    servings = {g["name"]: s for g, s in zip(RENAL_FOOD_GROUPS, counts)}
+    electrolytes = {
+        e: sum(s * g[e] for g, s in zip(RENAL_FOOD_GROUPS, counts)) for e in RENAL_ELECTROLYTES
+    }
+    return servings, electrolytes
+
+# Metrics
+# Per-route request counters/latency histograms (MetricsMiddleware) and
+# per-stage calculation timings, exposed in Prometheus text format at /metrics.
+# Observations are appended to a deque (thread-safe, ~tens of ns) and folded
+# into buckets lazily, so a timed stage costs well under a microsecond.
+METRICS_ENABLED = os.environ.get("DIET_METRICS", "1") == "1"
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.pending = deque()
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        self.pending.append(value)
+        if len(self.pending) > 4096:
+            self.fold()
+
+    def fold(self):
+        with self.lock:
+            while True:
+                try:
+                    value = self.pending.popleft()
+                except IndexError:
+                    break
+                self.counts[bisect_left(self.buckets, value)] += 1
+                self.count += 1
+                self.sum += value
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}    # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.help = {}
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def inc(self, name, labels, amount=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def histogram(self, name, labels):
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        return histogram
+
+    def render(self, extra=()):
+        # extra: (name, kind, help, labels, value) samples computed at scrape time
+        def fmt(labels):
+            if not labels:
+                return ""
+            return "{" + ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels) + "}"
+
+        lines = []
+        seen = set()
+
+        def header(name):
+            if name not in seen and name in self.help:
+                seen.add(name)
+                kind, text = self.help[name]
+                lines.append("# HELP %s %s" % (name, text))
+                lines.append("# TYPE %s %s" % (name, kind))
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+        for (name, labels), value in counters:
+            header(name)
+            lines.append("%s%s %s" % (name, fmt(labels), value))
+        for (name, labels), histogram in histograms:
+            histogram.fold()
+            header(name)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append("%s_bucket%s %d" % (name, fmt(labels + (("le", bound),)), cumulative))
+            lines.append("%s_sum%s %r" % (name, fmt(labels), histogram.sum))
+            lines.append("%s_count%s %d" % (name, fmt(labels), histogram.count))
+        for name, kind, text, labels, value in extra:
+            if name not in seen:
+                seen.add(name)
+                lines.append("# HELP %s %s" % (name, text))
+                lines.append("# TYPE %s %s" % (name, kind))
+            lines.append("%s%s %s" % (name, fmt(labels), value))
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+METRICS.describe("diet_http_requests_total", "counter", "HTTP requests by route and status.")
+METRICS.describe("diet_http_request_duration_seconds", "histogram", "HTTP request latency by route.")
+METRICS.describe("diet_stage_duration_seconds", "histogram", "Calculation stage latency.")
+
+STAGE_HISTOGRAMS = {}
+STAGE_SINK = None  # set inside engine pool workers, which ship their timings back
+
+def observe_stage(calculation, stage, seconds):
+    histogram = STAGE_HISTOGRAMS.get((calculation, stage))
+    if histogram is None:
+        histogram = STAGE_HISTOGRAMS[(calculation, stage)] = METRICS.histogram(
+            "diet_stage_duration_seconds", (("calculation", calculation), ("stage", stage))
+        )
+    histogram.observe(seconds)
+
+def record_stage(calculation, stage, started):
+    # Observe the time since `started` for one calculation stage; returns now
+    now = perf_counter()
+    if METRICS_ENABLED:
+        if STAGE_SINK is not None:
+            STAGE_SINK.append((calculation, stage, now - started))
+        else:
+            observe_stage(calculation, stage, now - started)
+    return now
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        started = perf_counter()
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            # Unmatched paths share one label to keep cardinality bounded
+            labels = (("method", scope["method"]), ("route", getattr(route, "path", "unmatched")))
+            METRICS.inc("diet_http_requests_total", labels + (("status", status[0]),))
+            METRICS.histogram("diet_http_request_duration_seconds", labels).observe(perf_counter() - started)
+
+app.add_middleware(MetricsMiddleware)
+
+# Admission control
+# Calculation requests pass an admission gate per worker before they run.
+# Clinical routes and the public /calculate/normal_user route have separate
+# lanes. Each lane has its own limit on requests in flight, so a public burst
+# can't take the capacity clinicians need. When a slot frees, waiting clinical
+# requests go first. A request is shed rather than left to queue without end:
+#   - 429 when its lane's queue is full;
+#   - 503 when the request at the head of the queue has already waited longer
+#     than the lane's max wait, or when this request's own wait runs out.
+# Both responses carry Retry-After. Other routes (metrics, cache, profiles,
+# reads) bypass the gate. DIET_ADMISSION=0 turns the gate off.
+ADMISSION_ENABLED = os.environ.get("DIET_ADMISSION", "1") == "1"
+ADMISSION_CONCURRENCY = int(os.environ.get("DIET_ADMISSION_CONCURRENCY", 64))  # all lanes, per worker
+ADMISSION_PUBLIC_PATHS = ("/calculate/normal_user",)
+ADMISSION_GATED_PREFIXES = ("/calculate", "/sessions")
+ADMISSION_GATED_METHODS = ("POST", "PATCH")
+ADMISSION_RETRY_AFTER = "1"  # seconds
+
+class AdmissionLane:
+    def __init__(self, name, concurrency, queue_size, max_wait):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.max_wait = max_wait  # seconds
+        self.active = 0
+        self.waiters = deque()  # (enqueued at, future), oldest first
+        self.labels = (("lane", name),)
+
+# Priority order: earlier lanes are admitted first when slots free up
+ADMISSION_LANES = [
+    AdmissionLane(
+        "clinical",
+        int(os.environ.get("DIET_CLINICAL_CONCURRENCY", ADMISSION_CONCURRENCY)),
+        int(os.environ.get("DIET_CLINICAL_QUEUE", 256)),
+        float(os.environ.get("DIET_CLINICAL_MAX_WAIT", 2.0))
+    ),
+    AdmissionLane(
+        "public",
+        int(os.environ.get("DIET_PUBLIC_CONCURRENCY", 16)),
+        int(os.environ.get("DIET_PUBLIC_QUEUE", 64)),
+        float(os.environ.get("DIET_PUBLIC_MAX_WAIT", 0.25))
+    ),
+]
+ADMISSION_LANE = {lane.name: lane for lane in ADMISSION_LANES}
+
+class AdmissionRejected(Exception):
+    def __init__(self, status, detail):
+        self.status = status
+        self.detail = detail
+
+class AdmissionController:
+    # Runs on one event loop: no locks, only futures handed over on release
+    def __init__(self, concurrency, lanes):
+        self.concurrency = concurrency
+        self.lanes = lanes
+        self.active = 0
+
+    def has_slot(self, lane):
+        return self.active < self.concurrency and lane.active < lane.concurrency
+
+    def admit(self, lane):
+        self.active += 1
+        lane.active += 1
+
+    def waiting_ahead(self, lane):
+        # Requests that would be admitted before a new arrival in this lane
+        for other in self.lanes:
+            if other.waiters:
+                return True
+            if other is lane:
+                return False
+        return False
+
+    async def acquire(self, lane):
+        if self.has_slot(lane) and not self.waiting_ahead(lane):
+            self.admit(lane)
+            METRICS.histogram("diet_admission_wait_seconds", lane.labels).observe(0.0)
+            return
+        now = monotonic()
+        if len(lane.waiters) >= lane.queue_size:
+            raise AdmissionRejected(429, f"The {lane.name} queue is full.")
+        if lane.waiters and now - lane.waiters[0][0] > lane.max_wait:
+            raise AdmissionRejected(503, f"The {lane.name} queue is overloaded.")
+        future = asyncio.get_running_loop().create_future()
+        entry = (now, future)
+        lane.waiters.append(entry)
+        try:
+            await asyncio.wait({future}, timeout=lane.max_wait)
+        except BaseException:
+            # Client gone while queued: give back a slot handed over meanwhile
+            if future.done():
+                self.release(lane)
+            else:
+                future.cancel()
+                lane.waiters.remove(entry)
+            raise
+        METRICS.histogram("diet_admission_wait_seconds", lane.labels).observe(monotonic() - now)
+        if not future.done():
+            future.cancel()
+            lane.waiters.remove(entry)
+            raise AdmissionRejected(503, f"Waited more than {lane.max_wait}s in the {lane.name} queue.")
+
+    def release(self, lane):
+        self.active -= 1
+        lane.active -= 1
+        # Hand freed slots to the oldest waiter of the highest-priority lane that can take one
+        for candidate in self.lanes:
+            while candidate.waiters and self.has_slot(candidate):
+                _, future = candidate.waiters.popleft()
+                self.admit(candidate)
+                future.set_result(None)
+
+ADMISSION = AdmissionController(ADMISSION_CONCURRENCY, ADMISSION_LANES)
+
+def admission_lane(scope):
+    if scope["method"] not in ADMISSION_GATED_METHODS:
+        return None
+    path = scope["path"]
+    if path in ADMISSION_PUBLIC_PATHS:
+        return ADMISSION_LANE["public"]
+    if path.startswith(ADMISSION_GATED_PREFIXES):
+        return ADMISSION_LANE["clinical"]
+    return None
+
+class AdmissionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        lane = admission_lane(scope) if scope["type"] == "http" and ADMISSION_ENABLED else None
+        if lane is None:
+            await self.app(scope, receive, send)
+            return
+        try:
+            await ADMISSION.acquire(lane)
+        except AdmissionRejected as e:
+            METRICS.inc("diet_admission_shed_total", lane.labels + (("status", e.status),))
+            response = JSONResponse(
+                {"detail": e.detail}, status_code=e.status, headers={"Retry-After": ADMISSION_RETRY_AFTER}
+            )
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            ADMISSION.release(lane)
+
+METRICS.describe("diet_admission_wait_seconds", "histogram", "Time calculation requests waited for admission.")
+METRICS.describe("diet_admission_shed_total", "counter", "Calculation requests shed by admission control.")
+# Added after MetricsMiddleware, so it runs outside it: shed requests never
+# reach the routes and are counted in diet_admission_shed_total only
+app.add_middleware(AdmissionMiddleware)
+
+# Added last, so CORS is the outermost middleware and its headers are on every
+# response, including the 429/503s shed by admission control
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+@app.get("/metrics")
+def metrics():
+    stats = RESULT_CACHE.stats()
+    extra = [
+        ("diet_result_cache_entries", "gauge", "Entries in the result cache.", (), stats["size"]),
+        ("diet_result_cache_hits_total", "counter", "Result cache hits.", (), stats["hits"]),
+        ("diet_result_cache_misses_total", "counter", "Result cache misses.", (), stats["misses"]),
+        ("diet_result_cache_evictions_total", "counter", "Result cache LRU evictions.", (), stats["evictions"]),
+        ("diet_result_cache_expirations_total", "counter", "Result cache TTL expirations.", (), stats["expirations"]),
+        ("diet_engine_inflight", "gauge", "Calculations running in the engine pool.", (), ENGINE["inflight"]),
+        ("diet_engine_waiting", "gauge", "Calculations waiting for an engine pool slot.", (), ENGINE["waiting"]),
+        ("diet_engine_offloaded_total", "counter", "Calculations completed in the engine pool.", (), ENGINE["offloaded"]),
+    ]
+    extra += [
+        ("diet_admission_queue_depth", "gauge", "Requests waiting for admission.", lane.labels, len(lane.waiters))
+        for lane in ADMISSION_LANES
+    ]
+    extra += [
+        ("diet_admission_active", "gauge", "Admitted requests in flight.", lane.labels, lane.active)
+        for lane in ADMISSION_LANES
+    ]
+    shared = shared_cache()
+    if shared is not None:
+        shared_stats = shared.stats()
+        extra += [
+            ("diet_shared_cache_entries", "gauge", "Entries in the cross-worker shared cache.", (), shared_stats["size"]),
+            ("diet_shared_cache_hits_total", "counter", "Shared cache hits in this worker.", (), shared_stats["hits"]),
+            ("diet_shared_cache_misses_total", "counter", "Shared cache misses in this worker.", (), shared_stats["misses"]),
+            ("diet_shared_cache_errors_total", "counter", "Shared cache operations that failed.", (), shared_stats["errors"]),
+        ]
+    if HISTORY is not None:
+        history = HISTORY.stats()
+        extra += [
+            ("diet_history_queued", "gauge", "Plan history records waiting to be written.", (), history["queued"]),
+            ("diet_history_written_total", "counter", "Plan history records written.", (), history["written"]),
+            ("diet_history_dropped_total", "counter", "Plan history records dropped on a full queue.", (), history["dropped"]),
+            ("diet_history_failed_total", "counter", "Plan history records that could not be encoded or written.", (), history["failed"]),
+        ]
+    return PlainTextResponse(METRICS.render(extra), media_type="text/plain; version=0.0.4")
+
+# Result cache
+# Clinicians re-open patient cards and the front end re-posts identical inputs;
+# results are cached on a canonical form of the input with LRU + TTL eviction.
+RESULT_CACHE_SIZE = int(os.environ.get("DIET_RESULT_CACHE_SIZE", 1024))
+RESULT_CACHE_TTL = float(os.environ.get("DIET_RESULT_CACHE_TTL", 300))  # seconds
+CACHE_BYPASS_HEADER = "x-cache-bypass"
+
+class ResultCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires_at, value), oldest first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] < monotonic():
+                del self.entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            return None if entry is None else entry[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "maxsize": self.maxsize,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
+
+RESULT_CACHE = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+
+def canonical_input_key(input):
+    # Defaults filled by model_dump, sex lower-cased, floats normalised (-0.0 -> 0.0)
+    items = []
+    for field, value in sorted(input.model_dump().items()):
+        if field == "sex":
+            value = value.lower()
+        elif isinstance(value, float):
+            value = round(value, 6) + 0.0
+        items.append((field, value))
+    return (type(input).__name__, tuple(items))
+
+def cache_bypassed(request):
+    if request is None:
+        return False
+    if request.headers.get(CACHE_BYPASS_HEADER, "").lower() in ("1", "true", "yes"):
+        return True
+    return "no-cache" in request.headers.get("cache-control", "").lower()
+
+async def cached_result(compute, input, request=None, heavy=False):
+    # Cache hits are answered on the event loop; misses go through the engine
+    reason = profile_reason(request)
+    if reason is not None:
+        return await profiled_result(compute, input, request, reason, heavy)
+    key = canonical_input_key(input)
+    shared = shared_cache()
+    if not cache_bypassed(request):
+        result = RESULT_CACHE.get(key)
+        if result is not None:
+            return result
+        if shared is not None:
+            result = await run_in_threadpool(shared.get, key)
+            if result is not None:
+                result = relink_static_fragments(result)
+                RESULT_CACHE.put(key, result)
+                return result
+    result = await run_engine(compute, input, heavy=heavy)
+    RESULT_CACHE.put(key, result)
+    if shared is not None:
+        await run_in_threadpool(shared.put, key, result)
+    return result
+
+@app.get("/cache/stats")
+def cache_stats():
+    stats = RESULT_CACHE.stats()
+    shared = shared_cache()
+    if shared is not None:
+        stats["shared"] = shared.stats()
+    return {"success": True, "data": stats}
+
+@app.delete("/cache")
+def clear_cache():
+    RESULT_CACHE.clear()
+    shared = shared_cache()
+    if shared is not None:
+        shared.clear()
+    return {"success": True, "message": "Cache cleared."}
+
+# Shared result cache
+# With DIET_SHARED_CACHE set to a file path, results (and renal allocations)
+# are also cached in a SQLite file that every uvicorn worker and engine
+# process on the host opens, behind each process's in-memory RESULT_CACHE.
+# SQLite's locking makes concurrent access safe; entries are evicted by TTL
+# and least-recent use once the file holds more than DIET_SHARED_CACHE_SIZE.
+# Keys are namespaced by a hash of this file, the food database and the renal
+# index, so a deploy never serves results computed by different code, and by
+# kind, so renal allocations never pass for results. Lookups run in the
+# threadpool; a hit is a plain read, with hit counts and recency written back
+# in batches. At startup the DIET_SHARED_CACHE_WARM most-hit results are
+# loaded into RESULT_CACHE.
+SHARED_CACHE_PATH = os.environ.get("DIET_SHARED_CACHE", "")
+SHARED_CACHE_SIZE = int(os.environ.get("DIET_SHARED_CACHE_SIZE", 100000))
+SHARED_CACHE_TTL = float(os.environ.get("DIET_SHARED_CACHE_TTL", 86400))  # seconds
+SHARED_CACHE_WARM = int(os.environ.get("DIET_SHARED_CACHE_WARM", 0))
+SHARED_CACHE_TRIM_EVERY = 256  # puts between eviction passes
+SHARED_CACHE_TOUCH_BATCH = 256  # buffered hits that trigger a write-back
+SHARED_CACHE_TOUCH_INTERVAL = 5  # seconds buffered hits may wait for a write-back
+
+SHARED_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shared_results (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    last_used REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS shared_results_last_used ON shared_results (last_used);
+CREATE INDEX IF NOT EXISTS shared_results_hits ON shared_results (hits);
+"""
+
+def cache_namespace():
+    digest = hashlib.sha1()
+    for path in (os.path.abspath(__file__), FOOD_DB_PATH, RENAL_INDEX_PATH):
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+class SharedCache:
+    def __init__(self, path, maxsize, ttl, namespace):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.touched = {}  # key -> (hits since the last write-back, last used)
+        self.touched_at = monotonic()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.puts = 0
+        # Autocommit: every statement is its own short transaction
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=5, isolation_level=None)
+        try:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.executescript(SHARED_CACHE_SCHEMA)
+        except sqlite3.Error:
+            self.db.close()
+            raise
+
+    def prefix(self, kind):
+        return f"{self.namespace}:{kind}:"
+
+    def get(self, key, kind="result"):
+        name = self.prefix(kind) + repr(key)
+        now = time()
+        try:
+            with self.lock:
+                row = self.db.execute("SELECT value, expires_at FROM shared_results WHERE key = ?", (name,)).fetchone()
+                if row is None or row[1] < now:
+                    self.misses += 1
+                    return None
+                self.hits += 1
+                hits, _ = self.touched.get(name, (0, now))
+                self.touched[name] = (hits + 1, now)
+                if len(self.touched) >= SHARED_CACHE_TOUCH_BATCH or monotonic() - self.touched_at > SHARED_CACHE_TOUCH_INTERVAL:
+                    self.write_touched()
+        except sqlite3.Error:
+            # A busy or broken cache file must never fail a calculation
+            self.errors += 1
+            return None
+        return json.loads(row[0])
+
+    def write_touched(self):
+        # Called with the lock held; one transaction for all buffered hits.
+        # Hit counts only rank warm-up and eviction, so a failed write-back
+        # drops them rather than retrying.
+        touched, self.touched, self.touched_at = self.touched, {}, monotonic()
+        if not touched:
+            return
+        try:
+            with self.db:
+                self.db.execute("BEGIN")
+                self.db.executemany(
+                    "UPDATE shared_results SET last_used = max(last_used, ?), hits = hits + ? WHERE key = ?",
+                    [(last_used, hits, name) for name, (hits, last_used) in touched.items()]
+                )
+        except sqlite3.Error:
+            self.errors += 1
+
+    def put(self, key, value, kind="result"):
+        now = time()
+        try:
+            with self.lock:
+                self.db.execute(
+                    "INSERT INTO shared_results (key, value, expires_at, last_used) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at, "
+                    "last_used = excluded.last_used",
+                    (self.prefix(kind) + repr(key), encode_json(value).decode("utf-8"), now + self.ttl, now)
+                )
+                self.puts += 1
+                if self.puts % SHARED_CACHE_TRIM_EVERY == 0:
+                    self.trim(now)
+        except sqlite3.Error:
+            self.errors += 1
+
+    def trim(self, now):
+        self.db.execute("DELETE FROM shared_results WHERE expires_at < ?", (now,))
+        excess = self.db.execute("SELECT count(*) FROM shared_results").fetchone()[0] - self.maxsize
+        if excess > 0:
+            self.db.execute(
+                "DELETE FROM shared_results WHERE key IN (SELECT key FROM shared_results ORDER BY last_used LIMIT ?)",
+                (excess,)
+            )
+
+    def most_used(self, n, kind="result"):
+        # (key, value) of the n most-hit live entries of this namespace and kind
+        prefix = self.prefix(kind)
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT key, value FROM shared_results WHERE key >= ? AND key < ? AND expires_at >= ? "
+                "ORDER BY hits DESC LIMIT ?",
+                (prefix, prefix[:-1] + ";", time(), n)
+            ).fetchall()
+        return [(ast.literal_eval(key[len(prefix):]), json.loads(value)) for key, value in rows]
+
+    def clear(self):
+        with self.lock:
+            self.db.execute("DELETE FROM shared_results")
+
+    def stats(self):
+        with self.lock:
+            size = self.db.execute("SELECT count(*) FROM shared_results").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "path": SHARED_CACHE_PATH,
+            "size": size,
+            "maxsize": self.maxsize,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "errors": self.errors
+        }
+
+    def close(self):
+        with self.lock:
+            self.write_touched()
+            self.db.close()
+
+SHARED_CACHE_STATE = {"cache": None, "pid": None}
+SHARED_CACHE_LOCK = threading.Lock()
+
+def shared_cache():
+    # Opened lazily once per process (sqlite connections must not cross a fork)
+    if not SHARED_CACHE_PATH:
+        return None
+    if SHARED_CACHE_STATE["pid"] != os.getpid():
+        with SHARED_CACHE_LOCK:
+            if SHARED_CACHE_STATE["pid"] != os.getpid():
+                try:
+                    SHARED_CACHE_STATE["cache"] = SharedCache(
+                        SHARED_CACHE_PATH, SHARED_CACHE_SIZE, SHARED_CACHE_TTL, cache_namespace()
+                    )
+                except sqlite3.Error:
+                    # A corrupt file, or one locked past the timeout, leaves this
+                    # process on its in-memory cache rather than failing requests
+                    SHARED_CACHE_STATE["cache"] = None
+                SHARED_CACHE_STATE["pid"] = os.getpid()
+    return SHARED_CACHE_STATE["cache"]
+
+def relink_static_fragments(result):
+    # Results from the shared cache or a pool worker hold copies of the static
+    # payloads; point them back at the registered objects so FastJSONResponse
+    # and lean responses can splice them again. Lists, tuples and batch
+    # "results" are walked one level down.
+    if isinstance(result, (list, tuple)):
+        for item in result:
+            relink_static_fragments(item)
+        return result
+    if not isinstance(result, dict):
+        return result
+    data = result.get("data")
+    if isinstance(data, dict):
+        for key, value in data.items():
+            if not isinstance(value, (dict, list)):
+                continue
+            for static in STATIC_OBJECTS:
+                if value == static:
+                    data[key] = static
+                    break
+    if isinstance(result.get("results"), list):
+        relink_static_fragments(result["results"])
+    return result
+
+def warm_result_cache():
+    cache = shared_cache()
+    if cache is None or SHARED_CACHE_WARM <= 0:
+        return
+    for key, value in cache.most_used(SHARED_CACHE_WARM):
+        RESULT_CACHE.put(key, relink_static_fragments(value))
+
+def close_shared_cache():
+    if SHARED_CACHE_STATE["cache"] is not None and SHARED_CACHE_STATE["pid"] == os.getpid():
+        SHARED_CACHE_STATE["cache"].close()
+    SHARED_CACHE_STATE["cache"] = SHARED_CACHE_STATE["pid"] = None
+
+STARTUP_HOOKS.append(warm_result_cache)
+SHUTDOWN_HOOKS.append(close_shared_cache)
+
+# Calculation engine
+# Light calculations run inline. Heavy ones (uncached renal allocations, large
+# batches, bulk rows) run in a worker thread, or with DIET_ENGINE_PROCESSES > 0
+# in a process pool, so they never stall the event loop or hold the GIL against
+# other requests. DIET_ENGINE_MAX_QUEUE caps in-flight pool tasks; further
+# requests wait for a slot instead of piling onto the pool's queue.
+ENGINE_PROCESSES = int(os.environ.get("DIET_ENGINE_PROCESSES", 0))
+ENGINE_MAX_QUEUE = int(os.environ.get("DIET_ENGINE_MAX_QUEUE", max(1, ENGINE_PROCESSES) * 4))
+ENGINE_INLINE_BATCH = 64  # smaller batches aren't worth a pool round trip
+
+ENGINE = {"pool": None, "slots": None, "loop": None, "inflight": 0, "waiting": 0, "offloaded": 0}
+ENGINE_LOCK = threading.Lock()
+
+def engine_pool():
+    if ENGINE_PROCESSES <= 0:
+        return None
+    with ENGINE_LOCK:
+        if ENGINE["pool"] is None:
+            # spawn: forking a process that already runs threads isn't safe
+            ENGINE["pool"] = ProcessPoolExecutor(ENGINE_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+        return ENGINE["pool"]
+
+def shutdown_engine():
+    with ENGINE_LOCK:
+        pool, ENGINE["pool"] = ENGINE["pool"], None
+    if pool is not None:
+        pool.shutdown(cancel_futures=True)
+
+SHUTDOWN_HOOKS.append(shutdown_engine)
+
+def engine_task(compute, args):
+    # Runs in a pool worker; stage timings are returned with the result and
+    # replayed into the parent's METRICS, the only ones /metrics reports
+    global STAGE_SINK
+    STAGE_SINK = []
+    try:
+        return compute(*args), STAGE_SINK
+    finally:
+        STAGE_SINK = None
+
+def engine_slots():
+    # The semaphore belongs to the running loop (tests create one per client)
+    loop = asyncio.get_running_loop()
+    if ENGINE["loop"] is not loop:
+        ENGINE["slots"], ENGINE["loop"] = asyncio.Semaphore(ENGINE_MAX_QUEUE), loop
+    return ENGINE["slots"]
+
+async def run_engine(compute, *args, heavy=True):
+    if not heavy:
+        return compute(*args)
+    pool = engine_pool()
+    if pool is None:
+        return await run_in_threadpool(compute, *args)
+    slots = engine_slots()
+    ENGINE["waiting"] += 1
+    try:
+        await slots.acquire()
+    finally:
+        ENGINE["waiting"] -= 1
+    ENGINE["inflight"] += 1
+    try:
+        result, stages = await asyncio.get_running_loop().run_in_executor(pool, engine_task, compute, args)
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM-killed): answer this request in a thread and
+        # let the next heavy request start a fresh pool
+        with ENGINE_LOCK:
+            if ENGINE["pool"] is pool:
+                ENGINE["pool"] = None
+        pool.shutdown(wait=False)
+        return await run_in_threadpool(compute, *args)
+    finally:
+        ENGINE["inflight"] -= 1
+        slots.release()
+    ENGINE["offloaded"] += 1
+    if METRICS_ENABLED:
+        for calculation, stage, seconds in stages:
+            observe_stage(calculation, stage, seconds)
+    # The result was pickled across the process boundary
+    return relink_static_fragments(result)
+
+# Request profiling
+# A calculation is profiled when its request carries "X-Profile: 1" or is
+# picked at random at DIET_PROFILE_SAMPLE_RATE (0-1, default 0). Profiled
+# requests skip the result cache and run their calculation under cProfile in
+# whichever thread or pool worker the engine uses; only the per-function
+# totals come back. The last DIET_PROFILE_BUFFER traces are kept in memory and
+# /profiles/report aggregates them into hot-function tables. Unprofiled
+# requests pay one header lookup.
+PROFILE_HEADER = "x-profile"
+PROFILE_SAMPLE_RATE = float(os.environ.get("DIET_PROFILE_SAMPLE_RATE", 0))
+PROFILE_BUFFER_SIZE = int(os.environ.get("DIET_PROFILE_BUFFER", 100))
+PROFILE_SORT_KEYS = ("tottime", "cumtime", "calls")
+
+PROFILES = deque(maxlen=PROFILE_BUFFER_SIZE)  # newest last
+
+def profile_reason(request):
+    if request is None:
+        return None
+    if request.headers.get(PROFILE_HEADER, "").lower() in ("1", "true", "yes"):
+        return "header"
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        return "sample"
+    return None
+
+def profiled_task(compute, args):
+    # Runs where the calculation runs, so the profile covers the working thread
+    profiler = cProfile.Profile()
+    started = perf_counter()
+    profiler.enable()
+    try:
+        result = compute(*args)
+    finally:
+        profiler.disable()
+    seconds = perf_counter() - started
+    profiler.create_stats()
+    # (file, line, function) -> (primitive calls, calls, own time, cumulative time); callers dropped
+    stats = {func: (cc, nc, tt, ct) for func, (cc, nc, tt, ct, _) in profiler.stats.items()}
+    return result, seconds, stats
+
+async def profiled_result(compute, input, request, reason, heavy):
+    result, seconds, stats = await run_engine(profiled_task, compute, (input,), heavy=heavy)
+    PROFILES.append({
+        "id": uuid.uuid4().hex,
+        "path": request.url.path,
+        "calculation": compute.__name__,
+        "reason": reason,
+        "created_at": format_timestamp(time()),
+        "wall_ms": round(seconds * 1e3, 3),
+        "stats": stats
+    })
+    return result
+
+def function_label(func):
+    filename, line, name = func
+    if filename == "~":
+        return name  # built-in, already "<built-in method ...>"
+    return f"{os.path.basename(filename)}:{line}({name})"
+
+def hot_functions(traces, sort, top):
+    totals = {}
+    for trace in traces:
+        for func, (_, calls, own, cumulative) in trace["stats"].items():
+            entry = totals.setdefault(func, [0, 0.0, 0.0])
+            entry[0] += calls
+            entry[1] += own
+            entry[2] += cumulative
+    wall = sum(trace["wall_ms"] for trace in traces) / 1e3
+    order = {"calls": 0, "tottime": 1, "cumtime": 2}[sort]
+    ranked = sorted(totals.items(), key=lambda item: item[1][order], reverse=True)[:top]
+    return [
+        {
+            "function": function_label(func),
+            "calls": calls,
+            "tottime_ms": round(own * 1e3, 3),
+            "cumtime_ms": round(cumulative * 1e3, 3),
+            "tottime_per_trace_ms": round(own * 1e3 / len(traces), 3),
+            "tottime_percent": round(100 * own / wall, 1) if wall else 0.0
+        }
+        for func, (calls, own, cumulative) in ranked
+    ]
+
+def profile_summary(trace):
+    return {key: value for key, value in trace.items() if key != "stats"}
+
+def profile_sort(sort):
+    if sort not in PROFILE_SORT_KEYS:
+        raise HTTPException(status_code=422, detail=f"sort must be one of {', '.join(PROFILE_SORT_KEYS)}.")
+    return sort
+
+@app.get("/profiles")
+def list_profiles(path: Optional[str] = None):
+    traces = [profile_summary(t) for t in reversed(PROFILES) if path is None or t["path"] == path]
+    return {"success": True, "count": len(traces), "profiles": traces}
+
+@app.get("/profiles/report")
+def profiles_report(path: Optional[str] = None, calculation: Optional[str] = None, sort: str = "tottime",
+                    top: int = Query(25, ge=1, le=500)):
+    # Hot functions summed over every buffered trace that matches the filters
+    traces = [
+        t for t in list(PROFILES)
+        if (path is None or t["path"] == path) and (calculation is None or t["calculation"] == calculation)
+    ]
+    return {
+        "success": True,
+        "traces": len(traces),
+        "wall_ms": round(sum(t["wall_ms"] for t in traces), 3),
+        "functions": hot_functions(traces, profile_sort(sort), top) if traces else []
+    }
+
+@app.get("/profiles/{profile_id}")
+def read_profile(profile_id: str, sort: str = "tottime", top: int = Query(25, ge=1, le=500)):
+    for trace in list(PROFILES):
+        if trace["id"] == profile_id:
+            return dict(profile_summary(trace), success=True, functions=hot_functions([trace], profile_sort(sort), top))
+    raise HTTPException(status_code=404, detail="Profile not found.")
+
+@app.delete("/profiles")
+def clear_profiles():
+    PROFILES.clear()
+    return {"success": True, "message": "Profiles cleared."}
+
+# Plan history
+# With DIET_HISTORY_DB set, calculations sent with an X-Patient-Id header are
+# recorded in SQLite (WAL mode). Requests only enqueue the record; a writer
+# thread encodes and inserts them in batches, one commit per batch. When the
+# queue is full the record is dropped and counted rather than making the
+# request wait. Reads use a small connection pool and the
+# (patient_id, created_at, id) index, so a patient's date range is an index
+# range scan whatever the table size.
+HISTORY_DB = os.environ.get("DIET_HISTORY_DB", "")
+HISTORY_POOL_SIZE = int(os.environ.get("DIET_HISTORY_POOL_SIZE", 4))
+HISTORY_QUEUE_SIZE = int(os.environ.get("DIET_HISTORY_QUEUE_SIZE", 10000))
+HISTORY_BATCH_SIZE = 500
+HISTORY_FLUSH_INTERVAL = 0.2  # seconds a partial batch may wait for more records
+HISTORY_CLOSE_TIMEOUT = 10  # seconds shutdown waits for the writer to drain the queue
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 500
+PATIENT_ID_HEADER = "x-patient-id"
+PATIENT_ID_MAX_LENGTH = 128
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS plans (
+    id INTEGER PRIMARY KEY,
+    patient_id TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    calculation TEXT NOT NULL,
+    input TEXT NOT NULL,
+    result TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS plans_patient_created ON plans (patient_id, created_at, id);
+"""
+
+class HistoryStore:
+    def __init__(self, path, pool_size, queue_size):
+        self.path = path
+        self.pool = queue.LifoQueue()
+        self.pending = queue.Queue(maxsize=queue_size)
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        writer_db = self.connect()
+        writer_db.execute("PRAGMA journal_mode=WAL")
+        writer_db.executescript(HISTORY_SCHEMA)
+        for _ in range(pool_size):
+            self.pool.put(self.connect())
+        self.writer = threading.Thread(target=self.write_behind, args=(writer_db,), name="history-writer", daemon=True)
+        self.writer.start()
+
+    def connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+        db.execute("PRAGMA synchronous=NORMAL")  # safe with WAL; commits don't fsync
+        return db
+
+    @contextmanager
+    def connection(self):
+        db = self.pool.get()
+        try:
+            yield db
+        finally:
+            self.pool.put(db)
+
+    def record(self, patient_id, calculation, input, result):
+        try:
+            self.pending.put_nowait((patient_id, time(), calculation, input, result))
+        except queue.Full:
+            self.dropped += 1
+
+    def write_behind(self, db):
+        stop = False
+        while not stop:
+            batch = [self.pending.get()]
+            deadline = monotonic() + HISTORY_FLUSH_INTERVAL
+            # Stop collecting at the close() sentinel so shutdown doesn't wait out the interval
+            while len(batch) < HISTORY_BATCH_SIZE and batch[-1] is not None:
+                try:
+                    batch.append(self.pending.get(timeout=max(deadline - monotonic(), 0)))
+                except queue.Empty:
+                    break
+            if None in batch:  # close() sentinel; everything queued before it is in the batch
+                stop = True
+                batch = [record for record in batch if record is not None]
+            # A record that can't be encoded (e.g. a NaN result) or a batch the
+            # database rejects is counted as failed; the writer keeps running
+            rows = []
+            for patient_id, created_at, calculation, input, result in batch:
+                try:
+                    rows.append((
+                        patient_id, created_at, calculation, input.model_dump_json(),
+                        encode_response(result).decode("utf-8")
+                    ))
+                except (TypeError, ValueError):
+                    self.failed += 1
+            if rows:
+                try:
+                    with db:
+                        db.executemany(
+                            "INSERT INTO plans (patient_id, created_at, calculation, input, result) VALUES (?, ?, ?, ?, ?)",
+                            rows
+                        )
+                except sqlite3.Error:
+                    self.failed += len(rows)
+                else:
+                    self.written += len(rows)
+        db.close()
+
+    def plans(self, patient_id, start, end, calculation, before, limit):
+        # Newest first; `before` is the (created_at, id) of the last row of the previous page
+        sql = "SELECT id, created_at, calculation, input, result FROM plans WHERE patient_id = ? AND created_at >= ? AND created_at < ?"
+        args = [patient_id, start, end]
+        if calculation:
+            sql += " AND calculation = ?"
+            args.append(calculation)
+        if before:
+            sql += " AND (created_at, id) < (?, ?)"
+            args.extend(before)
+        sql += " ORDER BY created_at DESC, id DESC LIMIT ?"
+        args.append(limit)
+        with self.connection() as db:
+            return db.execute(sql, args).fetchall()
+
+    def stats(self):
+        return {"queued": self.pending.qsize(), "written": self.written, "dropped": self.dropped, "failed": self.failed}
+
+    def close(self):
+        # Bounded so a stuck writer can't hang shutdown; unwritten records are lost
+        try:
+            self.pending.put(None, timeout=HISTORY_CLOSE_TIMEOUT)
+        except queue.Full:
+            pass
+        self.writer.join(HISTORY_CLOSE_TIMEOUT)
+        while not self.pool.empty():
+            self.pool.get().close()
+
+HISTORY = None
+
+def start_history():
+    global HISTORY
+    if HISTORY_DB and HISTORY is None:
+        HISTORY = HistoryStore(HISTORY_DB, HISTORY_POOL_SIZE, HISTORY_QUEUE_SIZE)
+
+def stop_history():
+    global HISTORY
+    if HISTORY is not None:
+        HISTORY.close()
+        HISTORY = None
+
+STARTUP_HOOKS.append(start_history)
+SHUTDOWN_HOOKS.append(stop_history)
+
+def patient_id(request):
+    value = request.headers.get(PATIENT_ID_HEADER, "").strip() if request is not None else ""
+    if len(value) > PATIENT_ID_MAX_LENGTH:
+        raise HTTPException(status_code=400, detail=f"X-Patient-Id must be at most {PATIENT_ID_MAX_LENGTH} characters.")
+    return value or None
+
+def record_history(request, calculation, input, result):
+    if HISTORY is not None:
+        patient = patient_id(request)
+        if patient:
+            HISTORY.record(patient, calculation, input, result)
+
+def parse_timestamp(name, value, default):
+    # ISO 8601 date or datetime (naive means UTC) -> unix seconds
+    if value is None:
+        return default
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=422, detail=f"{name} must be an ISO 8601 date or datetime.")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+def format_timestamp(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc).isoformat()
+
+@app.get("/patients/{patient}/plans")
+def patient_plans(patient: str, start: Optional[str] = None, end: Optional[str] = None,
+                  calculation: Optional[str] = None, cursor: Optional[str] = None,
+                  limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=HISTORY_MAX_PAGE_SIZE)):
+    if HISTORY is None:
+        raise HTTPException(status_code=503, detail="Plan history is not enabled (set DIET_HISTORY_DB).")
+    before = None
+    if cursor:
+        try:
+            created_at, plan_id = cursor.split(":")
+            before = (float(created_at), int(plan_id))
+        except ValueError:
+            raise HTTPException(status_code=422, detail="Invalid cursor.")
+    rows = HISTORY.plans(
+        patient, parse_timestamp("start", start, 0.0), parse_timestamp("end", end, float("inf")),
+        calculation, before, limit
+    )
+    # Stored input/result JSON is spliced in as is rather than parsed and re-encoded
+    plans = b",".join(
+        b'{"id":%d,"created_at":%s,"calculation":%s,"input":%s,"result":%s}' % (
+            plan_id, encode_json(format_timestamp(created_at)), encode_json(kind),
+            input.encode("utf-8"), result.encode("utf-8")
+        )
+        for plan_id, created_at, kind, input, result in rows
+    )
+    next_cursor = "%r:%d" % (rows[-1][1], rows[-1][0]) if len(rows) == limit else None
+    body = b'{"success":true,"patient_id":%s,"count":%d,"next_cursor":%s,"plans":[%s]}' % (
+        encode_json(patient), len(rows), encode_json(next_cursor), plans
+    )
+    return Response(body, media_type="application/json")
+
+# Response serialization
+# The static payloads below are identical in every response, so they are
+# encoded once at import time. FastJSONResponse encodes our known-shape result
+# dicts directly (no jsonable_encoder walk) and splices those bytes back in.
+# Opt in with DIET_FAST_JSON=1.
+FAST_JSON_RESPONSES = os.environ.get("DIET_FAST_JSON", "0") == "1"
+
+def encode_json(content):
+    # Same settings as starlette's JSONResponse.render
+    return json.dumps(
+        content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+    ).encode("utf-8")
+
+def strong_etag(body):
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+# id(static object) -> (marker, marker bytes, encoded bytes, lean bytes)
+STATIC_FRAGMENTS = {}
+STATIC_OBJECTS = []
+
+def register_static_fragment(name, value, href=None):
+    # Static objects with a reference endpoint are replaced by a link to it in
+    # lean responses; the others are inlined either way
+    marker = "\x00static:" + name
+    encoded = encode_json(value)
+    lean = encode_json({"href": href, "etag": strong_etag(encoded)}) if href else encoded
+    STATIC_FRAGMENTS[id(value)] = (marker, encode_json(marker), encoded, lean)
+    STATIC_OBJECTS.append(value)
+
+register_static_fragment("portion_references", PORTION_REFERENCES, "/references/portions")
+register_static_fragment("renal_portion_references", RENAL_PORTION_REFERENCES, "/references/renal-portions")
+register_static_fragment("meal_plan_example", MEAL_PLAN_EXAMPLE)
+
+def with_static_markers(data, spliced, lean=False):
+    # Shallow copy of a response "data" dict with static objects swapped for markers
+    if not isinstance(data, dict):
+        return data
+    marked = None
+    for key, value in data.items():
+        fragment = STATIC_FRAGMENTS.get(id(value))
+        if fragment is not None:
+            if marked is None:
+                marked = dict(data)
+            marked[key] = fragment[0]
+            spliced[fragment[1]] = fragment[3] if lean else fragment[2]
+    return data if marked is None else marked
+
+def encode_response(content, lean=False):
+    spliced = {}
+    if isinstance(content, dict):
+        if "data" in content:
+            content = dict(content, data=with_static_markers(content["data"], spliced, lean))
+        if isinstance(content.get("results"), list):
+            content = dict(content, results=[
+                dict(r, data=with_static_markers(r["data"], spliced, lean)) if isinstance(r, dict) and "data" in r else r
+                for r in content["results"]
+            ])
+    body = encode_json(content)
+    for marker, fragment in spliced.items():
+        body = body.replace(marker, fragment)
+    return body
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content):
+        return encode_response(content)
+
+class LeanJSONResponse(JSONResponse):
+    def render(self, content):
+        return encode_response(content, lean=True)
+
+# Clients that already hold the reference tables (GET /references/...) can ask
+# for lean responses, where each table is replaced by {"href", "etag"}
+LEAN_RESPONSE_HEADER = "x-lean-response"
+
+def lean_requested(request):
+    if request is None:
+        return False
+    return request.headers.get(LEAN_RESPONSE_HEADER, "").lower() in ("1", "true", "yes")
+
+def respond(result, calculation="diet", fast=False, request=None):
+    # Encode here rather than in FastAPI so serialization shows up as a stage.
+    # fast=True is for payloads of plain lists and numbers, where the
+    # jsonable_encoder walk is pure overhead.
+    started = perf_counter()
+    if lean_requested(request):
+        response = LeanJSONResponse(result)
+    elif fast or FAST_JSON_RESPONSES:
+        response = FastJSONResponse(result)
+    else:
+        response = JSONResponse(jsonable_encoder(result))
+    record_stage(calculation, "serialization", started)
+    return response
+
+def diet_response(bmi, bmr, tdee, carbs_g, protein_g, fats_g, food_exchanges, meal_distribution,
+                  portion_references, fluid_requirement_ml, pediatric_energy, burn_energy, residuals, meal_plan):
+    # Response shape shared by the single and batch normal/metabolic paths
+    return {
+        "success": True,
+        "message": "Calculation successful.",
+        "data": {
+            "BMI": round(bmi, 2),
+            "BMR": round(bmr, 2),
+            "TDEE": round(tdee, 2),
+            "macronutrients": {
+                "carbs_g": round(carbs_g, 2),
+                "protein_g": round(protein_g, 2),
+                "fats_g": round(fats_g, 2)
+            },
+            "food_exchanges": food_exchanges,
+            "meal_distribution": meal_distribution,
+            "portion_references": portion_references,
+            "fluid_requirement_ml": fluid_requirement_ml,
+            "pediatric_energy": pediatric_energy,
+            "burn_energy": burn_energy,
+            "residuals": residuals,
+            "meal_plan": meal_plan
+        }
+    }
+
+def compute_diet(input: DietInput):
+    t = perf_counter()
     # BMI
     height_m = input.height / 100
     bmi = input.weight / (height_m ** 2)
@@ -343,10 +2000,7 @@ def calculate_diet(input: DietInput):
     if input.bmr_override is not None:
         bmr = input.bmr_override
     else:
-        if input.sex.lower() == 'male':
-            bmr = 66.5 + (13.75 * input.weight) + (5.003 * input.height) - (6.75 * input.age)
-        else:
-            bmr = 655.1 + (9.563 * input.weight) + (1.85 * input.height) - (4.676 * input.age)
+        bmr = calculate_bmr(input.sex, input.weight, input.height, input.age)
 
     # TDEE
     tdee = bmr * input.activity_factor * input.stress_factor
@@ -358,36 +2012,44 @@ def calculate_diet(input: DietInput):
     carbs_g = ((input.carbs_percent / 100) * total_calories) / 4
     protein_g = ((input.protein_percent / 100) * total_calories) / 4
     fats_g = ((input.fats_percent / 100) * total_calories) / 9
+    t = record_stage("diet", "bmr_tdee", t)
 
     # Auto servings allocation
     servings_dict = auto_food_servings(carbs_g, protein_g, fats_g)
-    food_exchanges = calculate_food_exchanges(servings_dict)
+    t = record_stage("diet", "servings", t)
+    servings = servings_vector(servings_dict, FOOD_GROUP_NAMES)
+    per_group, totals = compute_exchanges(servings, FOOD_GROUP_MATRIX)
+    food_exchanges = exchange_dict(FOOD_GROUP_NAMES, servings.tolist(), per_group.tolist(), NORMAL_EXCHANGE_FIELDS)
 
     # Dynamic residuals
-    residuals = {
-        "carbs_g": round(carbs_g - sum([food_exchanges[g]["carbs_g"] for g in food_exchanges]), 2),
-        "protein_g": round(protein_g - sum([food_exchanges[g]["protein_g"] for g in food_exchanges]), 2),
-        "fats_g": round(fats_g - sum([food_exchanges[g]["fats_g"] for g in food_exchanges]), 2)
-    }
+    residuals = macro_residuals(carbs_g, protein_g, fats_g, totals.tolist())
+    t = record_stage("diet", "exchanges", t)
+
+    # One-day menu from the food database
+    meal_plan = meal_plan_for("normal", servings.tolist(), input.clinical_condition)
+    t = record_stage("diet", "meal_plan", t)
 
     # Meal distribution (automatic, based on clinical_condition)
     meal_distribution = calculate_meal_distribution(carbs_g, input.clinical_condition)
+    t = record_stage("diet", "meal_distribution", t)
 
     # Portion references (automatic)
     portion_references = PORTION_REFERENCES
 
     # Fluid requirements (automatic)
     fluid_requirement_ml = calculate_fluid_requirement(input.weight)
+    t = record_stage("diet", "fluid", t)
 
     # Pediatric energy requirements (automatic if age < 19)
     pediatric_energy = None
     if input.age < 19:
         pediatric_energy = {}
         eer, kcal_per_kg = calculate_pediatric_energy(
-            input.age, input.weight, input.height, input.sex, input.activity_factor
+            input.age, input.weight, input.height, input.sex.lower(), input.activity_factor
         )
         pediatric_energy["EER"] = eer
         pediatric_energy["kcal_per_kg"] = kcal_per_kg
+        t = record_stage("diet", "pediatric", t)
 
     # Burn calculations (automatic if clinical_condition is burn)
     burn_energy = None
@@ -401,49 +2063,18 @@ def calculate_diet(input: DietInput):
             body_temp=input.body_temp if input.body_temp is not None else 37,
             age_years=input.age
         )
+        t = record_stage("diet", "burn", t)
 
-    return {
-        "success": True,
-        "message": "Calculation successful.",
-        "data": {
-            "BMI": round(bmi, 2),
-            "BMR": round(bmr, 2),
-            "TDEE": round(tdee, 2),
-            "macronutrients": {
-                "carbs_g": round(carbs_g, 2),
-                "protein_g": round(protein_g, 2),
-                "fats_g": round(fats_g, 2)
-            },
-            "food_exchanges": food_exchanges,
-            "meal_distribution": meal_distribution,
-            "portion_references": portion_references,
-            "fluid_requirement_ml": fluid_requirement_ml,
-            "pediatric_energy": pediatric_energy,
-            "burn_energy": burn_energy,
-            "residuals": residuals,
-            # MEAL PLAN EXAMPLE
-            "meal_plan": {
-                "breakfast": [
-                    {"food": "Oats", "quantity": "1 cup"},
-                    {"food": "Milk", "quantity": "1 glass"}
-                ],
-                "lunch": [
-                    {"food": "Rice", "quantity": "1 cup"},
-                    {"food": "Chicken", "quantity": "100g"},
-                    {"food": "Vegetables", "quantity": "1 cup"}
-                ],
-                "dinner": [
-                    {"food": "Sweet Potato", "quantity": "1 cup"},
-                    {"food": "Fish", "quantity": "100g"},
-                    {"food": "Salad", "quantity": "1 cup"}
-                ],
-                "snacks": [
-                    {"food": "Apple", "quantity": "1"},
-                    {"food": "Almonds", "quantity": "10 pieces"}
-                ]
-            }
-        }
-    }
+    return diet_response(
+        bmi, bmr, tdee, carbs_g, protein_g, fats_g, food_exchanges, meal_distribution,
+        portion_references, fluid_requirement_ml, pediatric_energy, burn_energy, residuals, meal_plan
+    )
+
+@app.post("/calculate-normal-metabolic-diet")
+async def calculate_diet(input: DietInput, request: Request = None):
+    result = await cached_result(compute_diet, input, request)
+    record_history(request, "diet", input, result)
+    return respond(result, request=request)
 
 @app.post("/calculate/normal_user")
 async def calculate_normal_user(request: Request):
@@ -457,22 +2088,809 @@ async def calculate_normal_user(request: Request):
     # Fill in other required fields with defaults if needed
     # Use DietInput model for validation
     input_data = DietInput(**data)
-    return calculate_diet(input_data)
+    return await calculate_diet(input_data, request)
 
 @app.post("/calculate/dietitian")
-def calculate_dietitian(input: DietInput):
-    return calculate_diet(input)
+async def calculate_dietitian(input: DietInput, request: Request):
+    return await calculate_diet(input, request)
+
+# Recalculation sessions
+# The dietitian UI edits one field at a time. A session keeps the last inputs
+# and every intermediate value; a PATCH recomputes only the stages downstream
+# of the changed fields (stopping early where a stage's outputs come out the
+# same) and returns only the response keys that changed. Sessions live in this
+# process, so multi-worker deployments need sticky routing.
+SESSION_LIMIT = int(os.environ.get("DIET_SESSION_LIMIT", 10000))
+SESSION_TTL = float(os.environ.get("DIET_SESSION_TTL", 3600))  # seconds since last use
+SESSIONS = ResultCache(SESSION_LIMIT, SESSION_TTL)
+
+def session_bmi(v):
+    return {"bmi": v["weight"] / ((v["height"] / 100) ** 2)}
+
+def session_bmr(v):
+    bmr = v["bmr_override"]
+    if bmr is None:
+        bmr = calculate_bmr(v["sex"], v["weight"], v["height"], v["age"])
+    return {"bmr": bmr}
+
+def session_tdee(v):
+    return {"tdee": v["bmr"] * v["activity_factor"] * v["stress_factor"]}
+
+def session_macros(v):
+    total_calories = v["caloric_target"] if v["caloric_target"] else v["tdee"]
+    return {
+        "carbs_g": ((v["carbs_percent"] / 100) * total_calories) / 4,
+        "protein_g": ((v["protein_percent"] / 100) * total_calories) / 4,
+        "fats_g": ((v["fats_percent"] / 100) * total_calories) / 9,
+    }
+
+def session_exchanges(v):
+    servings = servings_vector(auto_food_servings(v["carbs_g"], v["protein_g"], v["fats_g"]), FOOD_GROUP_NAMES)
+    per_group, totals = compute_exchanges(servings, FOOD_GROUP_MATRIX)
+    return {
+        "food_exchanges": exchange_dict(FOOD_GROUP_NAMES, servings.tolist(), per_group.tolist(), NORMAL_EXCHANGE_FIELDS),
+        "residuals": macro_residuals(v["carbs_g"], v["protein_g"], v["fats_g"], totals.tolist()),
+    }
+
+def session_meal_plan(v):
+    servings = [v["food_exchanges"][name]["servings"] for name in FOOD_GROUP_NAMES]
+    return {"meal_plan": meal_plan_for("normal", servings, v["clinical_condition"])}
+
+def session_meal_distribution(v):
+    return {"meal_distribution": calculate_meal_distribution(v["carbs_g"], v["clinical_condition"])}
+
+def session_fluid(v):
+    return {"fluid_requirement_ml": calculate_fluid_requirement(v["weight"])}
+
+def session_pediatric(v):
+    if v["age"] >= 19:
+        return {"pediatric_energy": None}
+    eer, kcal_per_kg = calculate_pediatric_energy(
+        v["age"], v["weight"], v["height"], v["sex"].lower(), v["activity_factor"]
+    )
+    return {"pediatric_energy": {"EER": eer, "kcal_per_kg": kcal_per_kg}}
+
+def session_burn(v):
+    if not (v["clinical_condition"] and "burn" in v["clinical_condition"].lower()):
+        return {"burn_energy": None}
+    return {"burn_energy": calculate_burn_energy(
+        v["weight"],
+        tbsa=v["tbsa"] if v["tbsa"] is not None else 20,
+        bmr=v["bmr"],
+        sex=v["sex"],
+        normal_daily_calories=v["normal_daily_calories"] if v["normal_daily_calories"] is not None else 2000,
+        body_temp=v["body_temp"] if v["body_temp"] is not None else 37,
+        age_years=v["age"]
+    )}
+
+# (stage, values it reads, function) in dependency order; values are DietInput
+# fields or outputs of earlier stages
+SESSION_STAGES = (
+    ("bmi", ("weight", "height"), session_bmi),
+    ("bmr", ("bmr_override", "sex", "weight", "height", "age"), session_bmr),
+    ("tdee", ("bmr", "activity_factor", "stress_factor"), session_tdee),
+    ("macros", ("tdee", "caloric_target", "carbs_percent", "protein_percent", "fats_percent"), session_macros),
+    ("exchanges", ("carbs_g", "protein_g", "fats_g"), session_exchanges),
+    ("meal_plan", ("food_exchanges", "clinical_condition"), session_meal_plan),
+    ("meal_distribution", ("carbs_g", "clinical_condition"), session_meal_distribution),
+    ("fluid", ("weight",), session_fluid),
+    ("pediatric", ("age", "weight", "height", "sex", "activity_factor"), session_pediatric),
+    ("burn", ("clinical_condition", "weight", "tbsa", "bmr", "sex", "normal_daily_calories", "body_temp", "age"),
+     session_burn),
+)
+
+def run_session_stages(values, changed):
+    # Recompute the stages reading anything in `changed` (None: all of them);
+    # updates `values` in place and returns the names of the stages that ran
+    recomputed = []
+    for stage, reads, compute in SESSION_STAGES:
+        if changed is not None and changed.isdisjoint(reads):
+            continue
+        t = perf_counter()
+        outputs = compute(values)
+        record_stage("session", stage, t)
+        recomputed.append(stage)
+        for name, value in outputs.items():
+            if changed is not None and values.get(name) != value:
+                changed.add(name)
+            values[name] = value
+    return recomputed
+
+def session_data(values):
+    return diet_response(
+        values["bmi"], values["bmr"], values["tdee"], values["carbs_g"], values["protein_g"], values["fats_g"],
+        values["food_exchanges"], values["meal_distribution"], PORTION_REFERENCES, values["fluid_requirement_ml"],
+        values["pediatric_energy"], values["burn_energy"], values["residuals"], values["meal_plan"]
+    )["data"]
+
+def get_session(session_id):
+    session = SESSIONS.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found or expired.")
+    return session
+
+def session_response(session_id, session, message, data):
+    return {
+        "success": True,
+        "message": message,
+        "session_id": session_id,
+        "version": session["version"],
+        "data": data
+    }
+
+@app.post("/sessions")
+async def create_session(input: DietInput, request: Request):
+    values = input.model_dump()
+    run_session_stages(values, None)
+    session = {"values": values, "data": session_data(values), "version": 1}
+    session_id = uuid.uuid4().hex
+    SESSIONS.put(session_id, session)
+    return respond(session_response(session_id, session, "Session created.", session["data"]), "session", request=request)
+
+@app.get("/sessions/{session_id}")
+async def read_session(session_id: str, request: Request):
+    session = get_session(session_id)
+    return respond(session_response(session_id, session, "Session loaded.", session["data"]), "session", request=request)
+
+@app.patch("/sessions/{session_id}")
+async def update_session(session_id: str, request: Request, fields: Dict = Body(...)):
+    session = get_session(session_id)
+    values = session["values"]
+    unknown = sorted(set(fields) - set(DietInput.model_fields))
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"Unknown fields: {', '.join(unknown)}.")
+    try:
+        input = DietInput(**dict({name: values[name] for name in DietInput.model_fields}, **fields))
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=validation_errors(e))
+    # Work on a copy so a failing stage leaves the session as it was
+    updated = dict(values)
+    changed = set()
+    for name, value in input.model_dump().items():
+        if updated[name] != value:
+            updated[name] = value
+            changed.add(name)
+    recomputed = run_session_stages(updated, changed) if changed else []
+    data = session_data(updated)
+    delta = {key: value for key, value in data.items() if session["data"][key] != value}
+    if changed:
+        session.update(values=updated, data=data, version=session["version"] + 1)
+    SESSIONS.put(session_id, session)
+    result = session_response(session_id, session, "Session updated.", delta)
+    result["changed_fields"] = sorted(name for name in changed if name in DietInput.model_fields)
+    result["recomputed_stages"] = recomputed
+    return respond(result, "session", request=request)
+
+@app.delete("/sessions/{session_id}")
+async def delete_session(session_id: str):
+    get_session(session_id)
+    SESSIONS.pop(session_id)
+    return {"success": True, "message": "Session deleted."}
+
+# Batch (vectorized) calculation
+# Mirrors calculate_diet step by step on whole columns, so a ward round is a
+# handful of array operations instead of hundreds of requests.
+MEDICATION_KEYS = list(MEDICATION_CARB_DISTRIBUTION)
+MEDICATION_INDEX = {key: i for i, key in enumerate(MEDICATION_KEYS)}
+MEDICATION_MATRIX = np.array([MEDICATION_CARB_DISTRIBUTION[key] for key in MEDICATION_KEYS])
+
+def medication_index(medication_type):
+    key = medication_type.lower().replace(" ", "_") if medication_type else "default"
+    return MEDICATION_INDEX.get(key, MEDICATION_INDEX["default"])
+
+def rounded(values):
+    # round() per value: np.round differs from it in the last place
+    return [round(v, 2) for v in values.tolist()]
+
+def diet_input_columns(inputs):
+    # List of DietInput -> dict of columns (missing optionals become NaN)
+    def column(field):
+        return np.array([getattr(i, field) for i in inputs], dtype=np.float64)
+
+    def optional_column(field):
+        values = [getattr(i, field) for i in inputs]
+        return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+
+    return {
+        "age": np.array([i.age for i in inputs], dtype=np.int64),
+        "sex": [i.sex for i in inputs],
+        "weight": column("weight"),
+        "height": column("height"),
+        "activity_factor": column("activity_factor"),
+        "stress_factor": column("stress_factor"),
+        "caloric_target": optional_column("caloric_target"),
+        "carbs_percent": column("carbs_percent"),
+        "protein_percent": column("protein_percent"),
+        "fats_percent": column("fats_percent"),
+        "clinical_condition": [i.clinical_condition for i in inputs],
+        "tbsa": optional_column("tbsa"),
+        "body_temp": optional_column("body_temp"),
+        "normal_daily_calories": optional_column("normal_daily_calories"),
+        "bmr_override": optional_column("bmr_override"),
+    }
+
+def auto_food_servings_array(carbs_g, protein_g, fats_g):
+    # Column-wise auto_food_servings -> (patients x FOOD_GROUPS) servings matrix
+    servings = np.zeros((len(carbs_g), len(FOOD_GROUPS)), dtype=np.int64)
+    base = {"milk_skimmed": 2, "milk_full_cream": 0, "vegetables": 3, "fruits": 2, "sugar": 1, "legumes": 1}
+    for name, count in base.items():
+        servings[:, FOOD_GROUP_NAMES.index(name)] = count
+    used_carb = base["milk_skimmed"] * 12 + base["vegetables"] * 5 + base["fruits"] * 15 + base["legumes"] * 15
+    used_protein = base["milk_skimmed"] * 8 + base["vegetables"] * 2 + base["legumes"] * 7
+    # np.rint rounds half to even, exactly like round()
+    servings[:, FOOD_GROUP_NAMES.index("carbohydrates")] = np.maximum(np.rint((carbs_g - used_carb) / 15), 0)
+    servings[:, FOOD_GROUP_NAMES.index("protein")] = np.maximum(np.rint((protein_g - used_protein) / 7), 0)
+    servings[:, FOOD_GROUP_NAMES.index("fats")] = np.maximum(np.rint(fats_g / 5), 0)
+    return servings
+
+def burn_energy_columns(weight, bmr, tbsa, body_temp, normal_daily_calories):
+    # Toronto and Curreli on arrays (any broadcastable shapes), as in calculate_burn_energy
+    toronto = -4343 + (10.5 * tbsa) + (0.23 * normal_daily_calories) + (0.84 * bmr) + (114 * body_temp) - (4.5 * tbsa)
+    curreli = (25 * weight) + (40 * tbsa)
+    return toronto, curreli
+
+def calculate_diet_columns(cols):
+    age = cols["age"]
+    weight = cols["weight"]
+    height = cols["height"]
+    activity_factor = cols["activity_factor"]
+
+    # BMI
+    height_m = height / 100
+    bmi = weight / (height_m ** 2)
+
+    # BMR (Harris-Benedict or override)
+    male = np.array([sex.lower() == 'male' for sex in cols["sex"]], dtype=bool)
+    bmr_male = 66.5 + (13.75 * weight) + (5.003 * height) - (6.75 * age)
+    bmr_female = 655.1 + (9.563 * weight) + (1.85 * height) - (4.676 * age)
+    override = cols["bmr_override"]
+    bmr = np.where(np.isnan(override), np.where(male, bmr_male, bmr_female), override)
+
+    # TDEE and caloric target (a zero target falls back to TDEE, as in calculate_diet)
+    tdee = bmr * activity_factor * cols["stress_factor"]
+    target = cols["caloric_target"]
+    total_calories = np.where(np.isnan(target) | (target == 0), tdee, target)
+
+    # Macronutrient grams
+    carbs_g = ((cols["carbs_percent"] / 100) * total_calories) / 4
+    protein_g = ((cols["protein_percent"] / 100) * total_calories) / 4
+    fats_g = ((cols["fats_percent"] / 100) * total_calories) / 9
+
+    # Servings, per-group exchanges and exchange totals
+    servings = auto_food_servings_array(carbs_g, protein_g, fats_g)
+    exchanges, totals = compute_exchanges(servings, FOOD_GROUP_MATRIX)
+
+    # Meal distribution
+    rows = np.array([medication_index(c) for c in cols["clinical_condition"]], dtype=np.int64)
+    meal_distribution = carbs_g[:, None] * MEDICATION_MATRIX[rows]
+
+    # Fluid requirements
+    fluid = np.where(
+        weight <= 10, weight * 100,
+        np.where(weight <= 20, 1000 + (weight - 10) * 50, 1500 + (weight - 20) * 20)
+    )
+
+    # Pediatric EER (only reported where age < 19)
+    infant = (89 * weight) - 100
+    child = np.where(
+        male,
+        (88.5 - (61.9 * age)) + (activity_factor * ((26.7 * weight) + (903 * (height / 100)))),
+        (135.3 - (30.8 * age)) + (activity_factor * ((10 * weight) + (934 * (height / 100))))
+    )
+    eer = np.select(
+        [age < 0.25, age < 0.5, age < 1, age < 2, age < 3, age < 9],
+        [infant + 175, infant + 56, infant + 22, infant + 20, infant + 20, child + 20],
+        default=child + 25
+    )
+
+    # Burn equations (only reported for burn conditions)
+    tbsa = np.where(np.isnan(cols["tbsa"]), 20, cols["tbsa"])
+    normal_daily_calories = np.where(np.isnan(cols["normal_daily_calories"]), 2000, cols["normal_daily_calories"])
+    body_temp = np.where(np.isnan(cols["body_temp"]), 37, cols["body_temp"])
+    toronto, curreli = burn_energy_columns(weight, bmr, tbsa, body_temp, normal_daily_calories)
+
+    return {
+        "bmi": bmi,
+        "bmr": bmr,
+        "tdee": tdee,
+        "carbs_g": carbs_g,
+        "protein_g": protein_g,
+        "fats_g": fats_g,
+        "servings": servings,
+        "exchanges": exchanges,
+        "totals": totals,
+        "meal_distribution": meal_distribution,
+        "fluid_requirement_ml": fluid,
+        "eer": eer,
+        "toronto": toronto,
+        "curreli": curreli,
+    }
+
+def diet_batch_results(cols, arrays):
+    # Column results -> one calculate_diet response per patient
+    rows = zip(
+        cols["age"].tolist(), cols["weight"].tolist(), cols["clinical_condition"],
+        arrays["bmi"].tolist(), arrays["bmr"].tolist(), arrays["tdee"].tolist(),
+        arrays["carbs_g"].tolist(), arrays["protein_g"].tolist(), arrays["fats_g"].tolist(),
+        arrays["servings"].tolist(), arrays["exchanges"].tolist(), arrays["totals"].tolist(),
+        arrays["meal_distribution"].tolist(), arrays["fluid_requirement_ml"].tolist(),
+        arrays["eer"].tolist(), arrays["toronto"].tolist(), arrays["curreli"].tolist(),
+    )
+    results = []
+    # Patients with the same servings share one (read-only) exchanges dict
+    exchange_dicts = {}
+    for (age, weight, condition, bmi, bmr, tdee, carbs_g, protein_g, fats_g, servings, exchanges,
+         totals, meals, fluid, eer, toronto, curreli) in rows:
+        key = tuple(servings)
+        food_exchanges = exchange_dicts.get(key)
+        if food_exchanges is None:
+            food_exchanges = exchange_dicts[key] = exchange_dict(
+                FOOD_GROUP_NAMES, servings, exchanges, NORMAL_EXCHANGE_FIELDS
+            )
+        residuals = macro_residuals(carbs_g, protein_g, fats_g, totals)
+        meal_distribution = {meal: round(value, 2) for meal, value in zip(MEALS, meals)}
+        pediatric_energy = None
+        if age < 19:
+            pediatric_energy = {"EER": eer, "kcal_per_kg": eer / weight if eer and weight else None}
+        burn_energy = None
+        if condition and "burn" in condition.lower():
+            burn_energy = {"toronto": toronto, "curreli": curreli, "curreli_junior": None}
+        meal_plan = meal_plan_for("normal", servings, condition)
+        results.append(diet_response(
+            bmi, bmr, tdee, carbs_g, protein_g, fats_g, food_exchanges, meal_distribution,
+            PORTION_REFERENCES, fluid, pediatric_energy, burn_energy, residuals, meal_plan
+        ))
+    return results
+
+def compute_diet_batch(inputs):
+    t = perf_counter()
+    cols = diet_input_columns(inputs)
+    t = record_stage("batch", "columns", t)
+    arrays = calculate_diet_columns(cols)
+    t = record_stage("batch", "compute", t)
+    results = diet_batch_results(cols, arrays)
+    record_stage("batch", "assemble", t)
+    return results
+
+# Columnar batches
+# One list per input field instead of one object per patient: pydantic only
+# checks each list's element type, so no model is built per patient. Columns
+# accept exactly what the per-record models accept; a null entry in an
+# optional column takes the model default, like an omitted field. Either batch
+# input can answer in columns (?format=columnar), one list per result quantity.
+TEXT_COLUMNS = ("sex", "clinical_condition")
+
+class DietColumns(BaseModel):
+    # DietInput, one list per field and one entry per patient
+    age: List[int]
+    sex: List[str]
+    weight: List[float]
+    height: List[float]
+    activity_factor: List[float]
+    stress_factor: List[float]
+    caloric_target: Optional[List[Optional[float]]] = None
+    carbs_percent: List[float]
+    protein_percent: List[float]
+    fats_percent: List[float]
+    clinical_condition: Optional[List[Optional[str]]] = None
+    tbsa: Optional[List[Optional[float]]] = None
+    body_temp: Optional[List[Optional[float]]] = None
+    normal_daily_calories: Optional[List[Optional[float]]] = None
+    bmr_override: Optional[List[Optional[float]]] = None
+
+class RenalDietColumns(BaseModel):
+    # RenalDietInput, one list per field and one entry per patient
+    age: List[int]
+    sex: List[str]
+    weight: List[float]
+    height: List[float]
+    activity_factor: List[float]
+    stress_factor: List[float]
+    caloric_target: Optional[List[Optional[float]]] = None
+    carbs_percent: List[float]
+    protein_percent: List[float]
+    fats_percent: List[float]
+    clinical_condition: Optional[List[Optional[str]]] = None
+    potassium_limit: Optional[List[Optional[float]]] = None
+    phosphate_limit: Optional[List[Optional[float]]] = None
+    sodium_limit: Optional[List[Optional[float]]] = None
+
+def column_lists(columns, model):
+    # Columns model -> dict of lists with model defaults filled in for null
+    # entries; omitted optional columns are left out. Raises 422 on ragged columns.
+    lists = {name: value for name, value in columns if value is not None}
+    n = len(columns.age)
+    ragged = [name for name, value in lists.items() if len(value) != n]
+    if ragged:
+        raise HTTPException(
+            status_code=422,
+            detail=[{"loc": [name], "msg": f"Expected {n} values, got {len(lists[name])}."} for name in ragged]
+        )
+    for name, value in lists.items():
+        default = model.model_fields[name].default
+        if default is not None and None in value:
+            lists[name] = [default if v is None else v for v in value]
+    return lists
+
+def input_columns(columns, model):
+    # Columns model -> (row count, dict of arrays/lists like diet_input_columns)
+    lists = column_lists(columns, model)
+    cols = {}
+    for name, value in lists.items():
+        if name in TEXT_COLUMNS:
+            cols[name] = value
+        elif name == "age":
+            cols[name] = np.array(value, dtype=np.int64)
+        else:
+            cols[name] = np.array(value, dtype=np.float64)  # None -> NaN
+    return len(columns.age), cols
+
+def validated_diet_columns(columns):
+    n, cols = input_columns(columns, DietInput)
+    # Fill omitted optionals the way diet_input_columns reports missing values
+    for name in DietColumns.model_fields:
+        if name not in cols:
+            cols[name] = [None] * n if name in TEXT_COLUMNS else np.full(n, np.nan)
+    return cols
+
+def validation_errors(error):
+    return [{"loc": list(err["loc"]), "msg": err["msg"]} for err in error.errors()]
+
+async def parse_columns(request, model):
+    try:
+        return model.model_validate_json(await request.body())
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=validation_errors(e))
+
+def masked(values, mask):
+    # Column as a list with None where mask is False
+    return [v if keep else None for v, keep in zip(values, mask.tolist())]
+
+def diet_columns_result(cols, arrays):
+    # calculate_diet_columns output -> one list per response quantity (no menus:
+    # those are per patient, see /calculate-normal-metabolic-diet/menu)
+    totals = arrays["totals"]
+    pediatric = cols["age"] < 19
+    burn = np.array([bool(c) and "burn" in c.lower() for c in cols["clinical_condition"]], dtype=bool)
+    eer = arrays["eer"]
+    weight = cols["weight"]
+    kcal_per_kg = np.divide(eer, weight, out=np.full(len(eer), np.nan), where=(eer != 0) & (weight != 0))
+    return {
+        "success": True,
+        "message": "Batch calculation successful.",
+        "count": len(weight),
+        "columns": {
+            "BMI": rounded(arrays["bmi"]),
+            "BMR": rounded(arrays["bmr"]),
+            "TDEE": rounded(arrays["tdee"]),
+            "macronutrients": {
+                "carbs_g": rounded(arrays["carbs_g"]),
+                "protein_g": rounded(arrays["protein_g"]),
+                "fats_g": rounded(arrays["fats_g"])
+            },
+            "servings": dict(zip(FOOD_GROUP_NAMES, arrays["servings"].T.tolist())),
+            "meal_distribution": {meal: rounded(values) for meal, values in zip(MEALS, arrays["meal_distribution"].T)},
+            "fluid_requirement_ml": arrays["fluid_requirement_ml"].tolist(),
+            "pediatric_energy": {
+                "EER": masked(eer.tolist(), pediatric),
+                "kcal_per_kg": masked(kcal_per_kg.tolist(), pediatric & ~np.isnan(kcal_per_kg))
+            },
+            "burn_energy": {
+                "toronto": masked(arrays["toronto"].tolist(), burn),
+                "curreli": masked(arrays["curreli"].tolist(), burn)
+            },
+            "residuals": {
+                "carbs_g": rounded(arrays["carbs_g"] - totals[:, 0]),
+                "protein_g": rounded(arrays["protein_g"] - totals[:, 1]),
+                "fats_g": rounded(arrays["fats_g"] - totals[:, 2])
+            }
+        }
+    }
+
+def compute_diet_batch_columns(cols, columnar):
+    # Already-columnar input, answered as records or as columns
+    t = perf_counter()
+    arrays = calculate_diet_columns(cols)
+    t = record_stage("batch", "compute", t)
+    if columnar:
+        result = diet_columns_result(cols, arrays)
+    else:
+        results = diet_batch_results(cols, arrays)
+        result = {"success": True, "message": "Batch calculation successful.", "count": len(results), "results": results}
+    record_stage("batch", "assemble", t)
+    return result
+
+@app.post("/calculate-normal-metabolic-diet/batch")
+async def calculate_diet_batch(
+    inputs: List[DietInput], request: Request, format: str = Query("records", pattern="^(records|columnar)$")
+):
+    heavy = len(inputs) >= ENGINE_INLINE_BATCH
+    if format == "columnar":
+        t = perf_counter()
+        cols = diet_input_columns(inputs)
+        record_stage("batch", "columns", t)
+        result = await run_engine(compute_diet_batch_columns, cols, True, heavy=heavy)
+        return respond(result, "batch", fast=True)
+    results = await run_engine(compute_diet_batch, inputs, heavy=heavy)
+    return respond({
+        "success": True,
+        "message": "Batch calculation successful.",
+        "count": len(results),
+        "results": results
+    }, "batch", fast=True, request=request)
+
+@app.post(
+    "/calculate-normal-metabolic-diet/batch/columns",
+    openapi_extra={"requestBody": {"required": True, "content": {"application/json": {"schema": DietColumns.model_json_schema()}}}}
+)
+async def calculate_diet_batch_columns(request: Request, format: str = Query("records", pattern="^(records|columnar)$")):
+    # The body is parsed by pydantic straight from bytes, skipping FastAPI's json.loads pass
+    t = perf_counter()
+    columns = await parse_columns(request, DietColumns)
+    cols = validated_diet_columns(columns)
+    record_stage("batch", "columns", t)
+    result = await run_engine(
+        compute_diet_batch_columns, cols, format == "columnar", heavy=len(columns.age) >= ENGINE_INLINE_BATCH
+    )
+    return respond(result, "batch", fast=format == "columnar", request=request)
+
+# Parameter sweep
+# What-if exploration: one patient, a Cartesian grid over the tunable factors
+# and macro percentages, computed in one calculate_diet_columns pass and
+# returned as columns (one list per quantity) rather than a list of results.
+SWEEP_PARAMETERS = ("activity_factor", "stress_factor", "carbs_percent", "protein_percent", "fats_percent")
+SWEEP_MAX_POINTS = int(os.environ.get("DIET_SWEEP_MAX_POINTS", 100000))
+SWEEP_INLINE_POINTS = 1024  # smaller grids aren't worth a pool round trip
+
+class SweepRange(BaseModel):
+    start: float
+    stop: float  # inclusive
+    step: float
+
+class DietSweepInput(BaseModel):
+    patient: DietInput
+    # A list of values or a range per parameter; omitted parameters keep the patient's value
+    activity_factor: Optional[Union[List[float], SweepRange]] = None
+    stress_factor: Optional[Union[List[float], SweepRange]] = None
+    carbs_percent: Optional[Union[List[float], SweepRange]] = None
+    protein_percent: Optional[Union[List[float], SweepRange]] = None
+    fats_percent: Optional[Union[List[float], SweepRange]] = None
+    balanced_macros: bool = False  # keep only points whose macro percentages add up to 100
+
+def sweep_axis(name, spec, default):
+    if spec is None:
+        return np.array([default], dtype=np.float64)
+    if isinstance(spec, SweepRange):
+        if not np.isfinite([spec.start, spec.stop, spec.step]).all():
+            raise HTTPException(status_code=422, detail=f"{name}: range values must be finite numbers.")
+        if spec.step <= 0 or spec.stop < spec.start:
+            raise HTTPException(status_code=422, detail=f"{name}: range needs step > 0 and stop >= start.")
+        # Checked as a float: a tiny step or huge span would overflow int()
+        count = (spec.stop - spec.start) / spec.step + 1e-9
+        if not count < SWEEP_MAX_POINTS:
+            raise HTTPException(status_code=422, detail=f"{name}: range has more than {SWEEP_MAX_POINTS} values.")
+        # Range values are rounded to 10 decimals so 0.1 steps give 1.3, not
+        # 1.3000000000000003, i.e. the value a caller would send to the single
+        # endpoint. List values are used exactly as sent.
+        return np.round(spec.start + spec.step * np.arange(int(count) + 1), 10)
+    if not spec:
+        raise HTTPException(status_code=422, detail=f"{name}: list of values is empty.")
+    values = np.array(spec, dtype=np.float64)
+    if not np.isfinite(values).all():
+        raise HTTPException(status_code=422, detail=f"{name}: values must be finite numbers.")
+    return values
+
+def sweep_axes(sweep):
+    axes = {name: sweep_axis(name, getattr(sweep, name), getattr(sweep.patient, name)) for name in SWEEP_PARAMETERS}
+    points = 1
+    for values in axes.values():
+        points *= len(values)
+    if points > SWEEP_MAX_POINTS:
+        raise HTTPException(
+            status_code=422,
+            detail=f"Sweep grid has {points} points; the limit is {SWEEP_MAX_POINTS}."
+        )
+    return axes, points
+
+def compute_diet_sweep(patient, axes, balanced_macros):
+    t = perf_counter()
+    grid = dict(zip(axes, (g.ravel() for g in np.meshgrid(*axes.values(), indexing="ij"))))
+    if balanced_macros:
+        keep = np.isclose(grid["carbs_percent"] + grid["protein_percent"] + grid["fats_percent"], 100)
+        grid = {name: values[keep] for name, values in grid.items()}
+    # The patient repeated over the grid, swept parameters replaced by their columns
+    n = len(grid["activity_factor"])
+    cols = diet_input_columns([patient])
+    cols = {
+        name: [value[0]] * n if isinstance(value, list) else np.repeat(value, n)
+        for name, value in cols.items()
+    }
+    cols.update(grid)
+    t = record_stage("sweep", "grid", t)
+    arrays = calculate_diet_columns(cols)
+    t = record_stage("sweep", "compute", t)
+    totals = arrays["totals"]
+    result = {
+        "success": True,
+        "message": "Parameter sweep successful.",
+        "data": {
+            "BMI": round(float(arrays["bmi"][0]), 2) if n else None,
+            "BMR": round(float(arrays["bmr"][0]), 2) if n else None,
+            "count": n,
+            "axes": {name: values.tolist() for name, values in axes.items()},
+            "columns": dict(
+                {name: values.tolist() for name, values in grid.items()},
+                TDEE=rounded(arrays["tdee"]),
+                macronutrients={
+                    "carbs_g": rounded(arrays["carbs_g"]),
+                    "protein_g": rounded(arrays["protein_g"]),
+                    "fats_g": rounded(arrays["fats_g"])
+                },
+                servings=dict(zip(FOOD_GROUP_NAMES, arrays["servings"].T.tolist())),
+                residuals={
+                    "carbs_g": rounded(arrays["carbs_g"] - totals[:, 0]),
+                    "protein_g": rounded(arrays["protein_g"] - totals[:, 1]),
+                    "fats_g": rounded(arrays["fats_g"] - totals[:, 2])
+                }
+            )
+        }
+    }
+    record_stage("sweep", "assemble", t)
+    return result
+
+@app.post("/calculate-normal-metabolic-diet/sweep")
+async def calculate_diet_sweep(sweep: DietSweepInput):
+    axes, points = sweep_axes(sweep)
+    result = await run_engine(
+        compute_diet_sweep, sweep.patient, axes, sweep.balanced_macros, heavy=points >= SWEEP_INLINE_POINTS
+    )
+    return respond(result, "sweep", fast=True)
+
+# Burn trajectory
+# Daily energy targets over a burn admission: per patient, a series (or a
+# healing/defervescence curve) of open-wound TBSA and body temperature, and for
+# every patient x day the Toronto and Curreli estimates, the macros of the
+# chosen target and the exchange servings, all as (patients x days) arrays.
+# Series shorter than the projection carry their last value forward.
+BURN_MAX_DAYS = 365
+BURN_MAX_POINTS = int(os.environ.get("DIET_BURN_MAX_POINTS", 200000))  # patients x days
+BURN_EQUATIONS = ("toronto", "curreli")
+
+class BurnCurve(BaseModel):
+    # Exponential healing: open TBSA and fever (above 37 °C) halve every half-life
+    initial_tbsa: Optional[float] = None  # default: the patient's tbsa, or 20
+    healing_half_life_days: float = 21
+    initial_body_temp: Optional[float] = None  # default: the patient's body_temp, or 37
+    fever_half_life_days: float = 5
+
+class BurnTrajectoryPatient(BaseModel):
+    patient: DietInput
+    tbsa: Optional[List[float]] = None  # % TBSA still open, day 0 first
+    body_temp: Optional[List[float]] = None  # °C, day 0 first
+    curve: Optional[BurnCurve] = None  # used for whichever series is omitted
+    energy_equation: str = "toronto"  # which estimate the macros and servings follow
+
+class BurnTrajectoryInput(BaseModel):
+    days: int = 90
+    patients: List[BurnTrajectoryPatient]
+
+def burn_series(name, series, days):
+    if not series:
+        raise HTTPException(status_code=422, detail=f"{name}: series is empty.")
+    if len(series) > days:
+        raise HTTPException(status_code=422, detail=f"{name}: series is longer than the {days}-day projection.")
+    return series + [series[-1]] * (days - len(series))
+
+def burn_trajectory_columns(trajectory):
+    # Validated inputs -> per-patient columns and (patients x days) TBSA/temperature
+    days = trajectory.days
+    if not 1 <= days <= BURN_MAX_DAYS:
+        raise HTTPException(status_code=422, detail=f"days must be between 1 and {BURN_MAX_DAYS}.")
+    if len(trajectory.patients) * days > BURN_MAX_POINTS:
+        raise HTTPException(
+            status_code=422,
+            detail=f"Projection has {len(trajectory.patients) * days} patient-days; the limit is {BURN_MAX_POINTS}."
+        )
+    day = np.arange(days, dtype=np.float64)
+    tbsa = np.empty((len(trajectory.patients), days))
+    body_temp = np.empty((len(trajectory.patients), days))
+    for i, item in enumerate(trajectory.patients):
+        if item.energy_equation not in BURN_EQUATIONS:
+            raise HTTPException(
+                status_code=422, detail=f"energy_equation must be one of {', '.join(BURN_EQUATIONS)}."
+            )
+        curve = item.curve or BurnCurve()
+        if curve.healing_half_life_days <= 0 or curve.fever_half_life_days <= 0:
+            raise HTTPException(status_code=422, detail="Half-lives must be greater than 0.")
+        if item.tbsa is not None:
+            tbsa[i] = burn_series("tbsa", item.tbsa, days)
+        else:
+            initial = curve.initial_tbsa if curve.initial_tbsa is not None else item.patient.tbsa
+            tbsa[i] = (initial if initial is not None else 20) * 0.5 ** (day / curve.healing_half_life_days)
+        if item.body_temp is not None:
+            body_temp[i] = burn_series("body_temp", item.body_temp, days)
+        else:
+            initial = curve.initial_body_temp if curve.initial_body_temp is not None else item.patient.body_temp
+            fever = (initial if initial is not None else 37) - 37
+            body_temp[i] = 37 + fever * 0.5 ** (day / curve.fever_half_life_days)
+    return tbsa, body_temp
+
+def compute_burn_trajectory(trajectory, tbsa, body_temp):
+    t = perf_counter()
+    patients = [item.patient for item in trajectory.patients]
+    cols = diet_input_columns(patients)
+    arrays = calculate_diet_columns(cols)
+    t = record_stage("burn_trajectory", "patients", t)
+
+    # Every patient-day at once: per-patient columns broadcast against the days
+    normal_daily_calories = np.where(np.isnan(cols["normal_daily_calories"]), 2000, cols["normal_daily_calories"])
+    toronto, curreli = burn_energy_columns(
+        cols["weight"][:, None], arrays["bmr"][:, None], tbsa, body_temp, normal_daily_calories[:, None]
+    )
+    use_curreli = np.array([item.energy_equation == "curreli" for item in trajectory.patients], dtype=bool)
+    energy = np.where(use_curreli[:, None], curreli, toronto)
+    carbs_g = ((cols["carbs_percent"][:, None] / 100) * energy) / 4
+    protein_g = ((cols["protein_percent"][:, None] / 100) * energy) / 4
+    fats_g = ((cols["fats_percent"][:, None] / 100) * energy) / 9
+    shape = energy.shape
+    servings = auto_food_servings_array(carbs_g.ravel(), protein_g.ravel(), fats_g.ravel())
+    _, totals = compute_exchanges(servings, FOOD_GROUP_MATRIX)
+    servings = servings.reshape(shape + (len(FOOD_GROUPS),))
+    totals = totals.reshape(shape + (len(FOOD_COLUMNS),))
+    t = record_stage("burn_trajectory", "compute", t)
+
+    results = []
+    for i, item in enumerate(trajectory.patients):
+        results.append({
+            "BMR": round(float(arrays["bmr"][i]), 2),
+            "energy_equation": item.energy_equation,
+            "tbsa": rounded(tbsa[i]),
+            "body_temp": rounded(body_temp[i]),
+            "toronto": rounded(toronto[i]),
+            "curreli": rounded(curreli[i]),
+            "macronutrients": {
+                "carbs_g": rounded(carbs_g[i]),
+                "protein_g": rounded(protein_g[i]),
+                "fats_g": rounded(fats_g[i])
+            },
+            "servings": dict(zip(FOOD_GROUP_NAMES, servings[i].T.tolist())),
+            "residuals": {
+                "carbs_g": rounded(carbs_g[i] - totals[i, :, 0]),
+                "protein_g": rounded(protein_g[i] - totals[i, :, 1]),
+                "fats_g": rounded(fats_g[i] - totals[i, :, 2])
+            }
+        })
+    result = {
+        "success": True,
+        "message": "Burn trajectory calculation successful.",
+        "days": trajectory.days,
+        "count": len(results),
+        "results": results
+    }
+    record_stage("burn_trajectory", "assemble", t)
+    return result
+
+@app.post("/calculate-normal-metabolic-diet/burn-trajectory")
+async def calculate_burn_trajectory(trajectory: BurnTrajectoryInput):
+    tbsa, body_temp = burn_trajectory_columns(trajectory)
+    result = await run_engine(
+        compute_burn_trajectory, trajectory, tbsa, body_temp, heavy=tbsa.size >= SWEEP_INLINE_POINTS
+    )
+    return respond(result, "burn_trajectory", fast=True)
 
 @app.post("/calculate-renal-diet")
-def calculate_renal_diet(input: RenalDietInput = Body(...)):
+async def calculate_renal_diet(input: RenalDietInput = Body(...), request: Request = None):
+    result = await cached_result(compute_renal_diet, input, request, heavy=True)
+    record_history(request, "renal", input, result)
+    return respond(result, "renal", request=request)
+
+def compute_renal_diet(input: RenalDietInput):
+    t = perf_counter()
     # BMI
     height_m = input.height / 100
     bmi = input.weight / (height_m ** 2)
     # BMR (Harris-Benedict)
-    if input.sex.lower() == 'male':
-        bmr = 66.5 + (13.75 * input.weight) + (5.003 * input.height) - (6.75 * input.age)
-    else:
-        bmr = 655.1 + (9.563 * input.weight) + (1.85 * input.height) - (4.676 * input.age)
+    bmr = calculate_bmr(input.sex, input.weight, input.height, input.age)
     # TDEE
     tdee = bmr * input.activity_factor * input.stress_factor
     # Caloric target
@@ -481,35 +2899,33 @@ def calculate_renal_diet(input: RenalDietInput = Body(...)):
     carbs_g = ((input.carbs_percent / 100) * total_calories) / 4
     protein_g = ((input.protein_percent / 100) * total_calories) / 4
     fats_g = ((input.fats_percent / 100) * total_calories) / 9
+    t = record_stage("renal", "bmr_tdee", t)
     # Auto servings allocation (renal)
-    servings_dict, electrolyte_totals = auto_renal_servings(
+    servings_dict, _ = auto_renal_servings(
         carbs_g, protein_g, fats_g,
         input.potassium_limit, input.phosphate_limit, input.sodium_limit
     )
+    t = record_stage("renal", "servings", t)
     # Calculate food exchanges (with electrolytes)
-    food_exchanges = {}
-    for g in RENAL_FOOD_GROUPS:
-        s = servings_dict[g["name"]]
-        food_exchanges[g["name"]] = {
-            "servings": s,
-            "carbs_g": s * g["carb"],
-            "protein_g": s * g["protein"],
-            "fats_g": s * g["fat"],
-            "calories": s * g["cal"],
-            "k_mg": s * g["k"],
-            "na_mg": s * g["na"],
-            "po4_mg": s * g["po4"]
-        }
+    servings = servings_vector(servings_dict, RENAL_FOOD_GROUP_NAMES)
+    per_group, totals = compute_exchanges(servings, RENAL_FOOD_GROUP_MATRIX)
+    food_exchanges = exchange_dict(RENAL_FOOD_GROUP_NAMES, servings.tolist(), per_group.tolist(), len(EXCHANGE_FIELDS))
+    totals = totals.tolist()
     # Residuals
-    residuals = {
-        "carbs_g": round(carbs_g - sum([food_exchanges[g]["carbs_g"] for g in food_exchanges]), 2),
-        "protein_g": round(protein_g - sum([food_exchanges[g]["protein_g"] for g in food_exchanges]), 2),
-        "fats_g": round(fats_g - sum([food_exchanges[g]["fats_g"] for g in food_exchanges]), 2)
-    }
+    residuals = macro_residuals(carbs_g, protein_g, fats_g, totals)
+    t = record_stage("renal", "exchanges", t)
+    # One-day menu from the food database, within the electrolyte limits
+    meal_plan = meal_plan_for(
+        "renal", servings.tolist(), input.clinical_condition,
+        (input.potassium_limit, input.sodium_limit, input.phosphate_limit)
+    )
+    t = record_stage("renal", "meal_plan", t)
     # Meal distribution (reuse logic from normal, based on clinical_condition)
     meal_distribution = calculate_meal_distribution(carbs_g, input.clinical_condition)
+    t = record_stage("renal", "meal_distribution", t)
     # Fluid requirements
     fluid_requirement_ml = calculate_fluid_requirement(input.weight)
+    record_stage("renal", "fluid", t)
     # Response
     return {
         "success": True,
@@ -526,29 +2942,512 @@ def calculate_renal_diet(input: RenalDietInput = Body(...)):
         "food_exchanges": food_exchanges,
         "meal_distribution": meal_distribution,
             "fluid_requirement_ml": fluid_requirement_ml,
-            "electrolyte_totals": electrolyte_totals,
+            "electrolyte_totals": {"k": totals[4], "po4": totals[6], "na": totals[5]},
             "portion_references": RENAL_PORTION_REFERENCES,
             "residuals": residuals,
-            # MEAL PLAN EXAMPLE
-            "meal_plan": {
-                "breakfast": [
-                    {"food": "Oats", "quantity": "1 cup"},
-                    {"food": "Milk", "quantity": "1 glass"}
-                ],
-                "lunch": [
-                    {"food": "Rice", "quantity": "1 cup"},
-                    {"food": "Chicken", "quantity": "100g"},
-                    {"food": "Vegetables", "quantity": "1 cup"}
-                ],
-                "dinner": [
-                    {"food": "Sweet Potato", "quantity": "1 cup"},
-                    {"food": "Fish", "quantity": "100g"},
-                    {"food": "Salad", "quantity": "1 cup"}
-                ],
-                "snacks": [
-                    {"food": "Apple", "quantity": "1"},
-                    {"food": "Almonds", "quantity": "10 pieces"}
-                ]
-            }
+            "meal_plan": meal_plan
+        }
+    } 
+
+# Per-meal apportionment
+# Splits each group's integer servings across MEALS for every medication
+# regimen at once: (regimens x groups x meals) arrays against MEDICATION_MATRIX.
+# Each meal gets the floor of its quota and the leftover servings go to meals
+# with a fractional quota (largest remainder, so no meal is ever more than one
+# serving off its share). Carb-bearing groups are placed first, and their
+# leftovers go to the meals furthest below their carb fraction so far, which
+# keeps per-meal carbs close to the regimen.
+def apportion_servings(servings, matrix, fractions):
+    # servings (groups,), fractions (regimens x meals) -> (regimens x groups x meals)
+    plan = np.zeros((len(fractions), len(servings), fractions.shape[1]), dtype=np.int64)
+    carbs = matrix[:, 0]
+    # Carb-free groups don't touch the carb placement, so they are apportioned
+    # all at once, by largest remainder alone
+    free = np.flatnonzero((carbs == 0) & (servings > 0))
+    if len(free):
+        quota = servings[free][None, :, None] * fractions[:, None, :]
+        base = np.floor(quota + 1e-9)
+        remainder = quota - base
+        left = servings[free] - base.sum(axis=2)
+        priority = np.where(remainder > 1e-9, remainder, -np.inf)
+        rank = np.argsort(np.argsort(-priority, axis=2, kind="stable"), axis=2)
+        plan[:, free] = base + (rank < left[:, :, None])
+    placed = np.zeros(fractions.shape)  # carbs placed per regimen and meal
+    carbs_total = 0
+    for g in np.argsort(-carbs, kind="stable")[:np.count_nonzero(carbs)]:
+        count = servings[g]
+        if count == 0:
+            continue
+        quota = count * fractions
+        base = np.floor(quota + 1e-9)
+        remainder = quota - base
+        left = count - base.sum(axis=1)
+        carbs_total += count * carbs[g]
+        priority = fractions * carbs_total - (placed + base * carbs[g])
+        priority = np.where(remainder > 1e-9, priority, -np.inf)
+        rank = np.argsort(np.argsort(-priority, axis=1, kind="stable"), axis=1)
+        plan[:, g] = base + (rank < left[:, None])
+        placed += plan[:, g] * carbs[g]
+    return plan
+
+def meal_plans(names, matrix, result, medication_type):
+    # Per-regimen meal plans for a calculation result's servings
+    data = result["data"]
+    servings = np.array([data["food_exchanges"][name]["servings"] for name in names], dtype=np.int64)
+    plan = apportion_servings(servings, matrix, MEDICATION_MATRIX)
+    meal_totals = np.einsum("rgm,gc->rmc", plan, matrix)  # regimens x meals x FOOD_COLUMNS
+    targets = data["macronutrients"]["carbs_g"] * MEDICATION_MATRIX
+    plans = {}
+    for i, key in enumerate(MEDICATION_KEYS):
+        plans[key] = {
+            "servings": dict(zip(names, plan[i].tolist())),
+            "carbs_g": meal_totals[i, :, 0].tolist(),
+            "protein_g": meal_totals[i, :, 1].tolist(),
+            "fats_g": meal_totals[i, :, 2].tolist(),
+            "carb_targets_g": [round(v, 2) for v in targets[i].tolist()],
         }
-    } 
\ No newline at end of file
+    return {
+        "success": True,
+        "message": "Meal plans calculated.",
+        "data": {
+            "meals": MEALS,
+            "regimen": MEDICATION_KEYS[medication_index(medication_type)],
+            "plans": plans
+        }
+    }
+
+@app.post("/calculate-normal-metabolic-diet/meal-plans")
+async def calculate_diet_meal_plans(input: DietInput, request: Request = None):
+    result = await cached_result(compute_diet, input, request)
+    t = perf_counter()
+    plans = meal_plans(FOOD_GROUP_NAMES, FOOD_GROUP_MATRIX, result, input.clinical_condition)
+    record_stage("meal_plans", "apportion", t)
+    return respond(plans, "meal_plans")
+
+@app.post("/calculate-renal-diet/meal-plans")
+async def calculate_renal_diet_meal_plans(input: RenalDietInput, request: Request = None):
+    result = await cached_result(compute_renal_diet, input, request, heavy=True)
+    t = perf_counter()
+    plans = meal_plans(RENAL_FOOD_GROUP_NAMES, RENAL_FOOD_GROUP_MATRIX, result, input.clinical_condition)
+    record_stage("meal_plans", "apportion", t)
+    return respond(plans, "meal_plans")
+
+# Food database and menus
+# Foods come from a composition file (DIET_FOOD_DB, default data/foods.csv):
+# one row per food and diet with the portion that makes one exchange of its
+# FOOD_GROUPS (diet "normal") or RENAL_FOOD_GROUPS (diet "renal") group, and
+# the K/Na/PO4 in that portion.
+# The file is read once into arrays. Each group keeps its foods sorted by K,
+# Na and PO4, so "foods in this group under these caps" is a searchsorted per
+# electrolyte and a filter over the shortest matching prefix, never a scan.
+FOOD_DB_PATH = os.environ.get(
+    "DIET_FOOD_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "foods.csv")
+)
+FOOD_ELECTROLYTES = ("k_mg", "na_mg", "po4_mg")  # same order as FOOD_COLUMNS k, na, po4
+MENU_MAX_DAYS = 14
+MENU_CACHE_SIZE = 4096  # menus are shared by every response with the same servings, regimen and limits
+MENU_TABLES = {
+    "normal": (FOOD_GROUP_NAMES, FOOD_GROUP_MATRIX),
+    "renal": (RENAL_FOOD_GROUP_NAMES, RENAL_FOOD_GROUP_MATRIX),
+}
+# Legacy meal_plan keys for the six MEALS
+MEAL_PLAN_KEYS = {"BF": "breakfast", "MMS": "snacks", "Lunch": "lunch", "AS": "snacks", "Dinner": "dinner", "LNS": "snacks"}
+
+class FoodDatabase:
+    def __init__(self, path):
+        with open(path, newline="", encoding="utf-8") as f:
+            rows = list(csv.DictReader(f))
+        self.names = [row["name"] for row in rows]
+        self.quantities = [row["quantity"] for row in rows]
+        self.electrolytes = np.array(
+            [[float(row[e] or 0) for e in FOOD_ELECTROLYTES] for row in rows], dtype=np.float64
+        ).reshape(-1, len(FOOD_ELECTROLYTES))
+        self.indexes = {diet: self.build_indexes(rows, diet) for diet in MENU_TABLES}
+
+    def build_indexes(self, rows, diet):
+        known, _ = MENU_TABLES[diet]
+        members = {}
+        for i, row in enumerate(rows):
+            if row["diet"] != diet:
+                continue
+            if row["group"] not in known:
+                raise ValueError(f"Food '{row['name']}' has unknown {diet} group '{row['group']}'.")
+            members.setdefault(row["group"], []).append(i)
+        indexes = {}
+        for group, ids in members.items():
+            ids = np.array(ids, dtype=np.int64)
+            index = {"ids": ids}
+            for col, electrolyte in enumerate(FOOD_ELECTROLYTES):
+                order = ids[np.argsort(self.electrolytes[ids, col], kind="stable")]
+                index[electrolyte] = (self.electrolytes[order, col], order)
+            indexes[group] = index
+        return indexes
+
+    def candidates(self, table, group, caps=None):
+        # Ids of the foods in `group` whose K, Na and PO4 are all within `caps`
+        index = self.indexes[table].get(group)
+        if index is None:
+            return np.zeros(0, dtype=np.int64)
+        if caps is None:
+            return index["ids"]
+        prefix = None
+        for electrolyte, cap in zip(FOOD_ELECTROLYTES, caps):
+            values, order = index[electrolyte]
+            n = np.searchsorted(values, cap, side="right")
+            if prefix is None or n < len(prefix):
+                prefix = order[:n]
+        return prefix[(self.electrolytes[prefix] <= caps).all(axis=1)]
+
+    def leanest(self, table, group, weights):
+        # The food with the least weighted K/Na/PO4, or None for an empty group
+        index = self.indexes[table].get(group)
+        if index is None:
+            return None
+        ids = index["ids"]
+        return ids[np.argmin(self.electrolytes[ids] @ weights)]
+
+def load_food_database(path):
+    # Without a food file, responses fall back to MEAL_PLAN_EXAMPLE
+    if not os.path.exists(path):
+        return None
+    return FoodDatabase(path)
+
+FOOD_DB = load_food_database(FOOD_DB_PATH)
+
+@lru_cache(maxsize=MENU_CACHE_SIZE)
+def leanest_foods(table, limits):
+    # Each group's leanest food (None for an empty group) and its K/Na/PO4:
+    # relative to the limits when there are some, else by plain mg
+    names, _ = MENU_TABLES[table]
+    if limits is None:
+        weights = np.ones(len(FOOD_ELECTROLYTES))
+    else:
+        limit = np.array([np.inf if v is None else v for v in limits], dtype=np.float64)
+        weights = np.where(np.isfinite(limit), 1 / np.maximum(limit, 1), 0)
+    lean = [FOOD_DB.leanest(table, name, weights) for name in names]
+    content = np.array([
+        np.zeros(len(FOOD_ELECTROLYTES)) if food is None else FOOD_DB.electrolytes[food] for food in lean
+    ])
+    return lean, content
+
+@lru_cache(maxsize=MENU_CACHE_SIZE)
+def generate_menu(table, servings, regimen, limits, days):
+    # servings: tuple per group; regimen: MEDICATION_MATRIX row; limits: (K, Na, PO4) mg/day or None.
+    # Foods are picked meal by meal against what is left of the day's limits,
+    # holding back room for each remaining item's leanest food, so a day only
+    # goes over a limit when the all-leanest menu would too.
+    names, matrix = MENU_TABLES[table]
+    per_meal = apportion_servings(np.array(servings, dtype=np.int64), matrix, MEDICATION_MATRIX[regimen:regimen + 1])[0]
+    meals_of, groups_of = np.nonzero(per_meal.T)  # meal-major, like the loop below
+    items = list(zip(meals_of.tolist(), groups_of.tolist(), per_meal[groups_of, meals_of].tolist()))
+    limited = limits is not None
+    lean, lean_content = leanest_foods(table, limits)
+    if limited:
+        limit = np.array([np.inf if v is None else v for v in limits], dtype=np.float64)
+    menu = []
+    uses = [0] * len(names)  # picks per group so far; cycling through choices varies meals and days
+    for day in range(days):
+        meals = {meal: [] for meal in MEALS}
+        totals = np.zeros(len(FOOD_ELECTROLYTES))
+        if limited:
+            budget = limit.copy()
+            reserve = sum(count * lean_content[g] for _, g, count in items)
+        for m, g, count in items:
+            caps = None
+            if limited:
+                reserve = reserve - count * lean_content[g]
+                caps = (budget - reserve) / count
+            choices = FOOD_DB.candidates(table, names[g], caps)
+            if len(choices):
+                food = choices[(g + day + uses[g]) % len(choices)]
+                uses[g] += 1
+            else:
+                food = lean[g]
+            if food is None:
+                meals[MEALS[m]].append({"food": names[g], "quantity": f"{count} exchange(s)", "group": names[g], "servings": count})
+                continue
+            quantity = FOOD_DB.quantities[food]
+            meals[MEALS[m]].append({
+                "food": FOOD_DB.names[food],
+                "quantity": quantity if count == 1 else f"{count} x {quantity}",
+                "group": names[g],
+                "servings": count
+            })
+            totals += count * FOOD_DB.electrolytes[food]
+            if limited:
+                budget = budget - count * FOOD_DB.electrolytes[food]
+        entry = {
+            "day": day + 1,
+            "meals": meals,
+            "electrolytes": {"k": round(totals[0], 1), "na": round(totals[1], 1), "po4": round(totals[2], 1)}
+        }
+        if limited:
+            entry["within_limits"] = bool((budget >= -1e-9).all())
+        menu.append(entry)
+    return menu
+
+def menu_for(table, servings, medication_type, limits=None, days=1):
+    if limits is not None:
+        limits = None if all(limit is None for limit in limits) else tuple(limits)
+    return generate_menu(table, tuple(servings), medication_index(medication_type), limits, days)
+
+def meal_plan_for(table, servings, medication_type, limits=None):
+    # One-day menu in the response's meal_plan shape (breakfast/lunch/dinner/snacks)
+    if FOOD_DB is None:
+        return MEAL_PLAN_EXAMPLE
+    day = menu_for(table, servings, medication_type, limits)[0]
+    if not day.get("within_limits", True):
+        # No food choice keeps this day under the limits; the group-level plan
+        # has the servings' own electrolyte content, which the solver kept within
+        return group_meal_plan(table, tuple(servings), medication_index(medication_type))
+    return meal_plan_from_menu(day)
+
+def meal_plan_from_menu(day):
+    plan = {"breakfast": [], "lunch": [], "dinner": [], "snacks": []}
+    for meal, items in day["meals"].items():
+        plan[MEAL_PLAN_KEYS[meal]].extend(items)
+    return plan
+
+@lru_cache(maxsize=MENU_CACHE_SIZE)
+def group_meal_plan(table, servings, regimen):
+    # Exchanges per meal by group, without naming foods
+    names, matrix = MENU_TABLES[table]
+    per_meal = apportion_servings(np.array(servings, dtype=np.int64), matrix, MEDICATION_MATRIX[regimen:regimen + 1])[0]
+    plan = {"breakfast": [], "lunch": [], "dinner": [], "snacks": []}
+    for m, meal in enumerate(MEALS):
+        for g in np.flatnonzero(per_meal[:, m]).tolist():
+            count = int(per_meal[g, m])
+            plan[MEAL_PLAN_KEYS[meal]].append(
+                {"food": names[g], "quantity": f"{count} exchange(s)", "group": names[g], "servings": count}
+            )
+    return plan
+
+def menu_response(table, result, medication_type, limits, days):
+    if FOOD_DB is None:
+        raise HTTPException(status_code=503, detail="No food database is loaded.")
+    names, _ = MENU_TABLES[table]
+    servings = [result["data"]["food_exchanges"][name]["servings"] for name in names]
+    return {
+        "success": True,
+        "message": "Menu generated.",
+        "data": {
+            "regimen": MEDICATION_KEYS[medication_index(medication_type)],
+            "days": menu_for(table, servings, medication_type, limits, days)
+        }
+    }
+
+@app.post("/calculate-normal-metabolic-diet/menu")
+async def calculate_diet_menu(input: DietInput, request: Request = None,
+                              days: int = Query(7, ge=1, le=MENU_MAX_DAYS)):
+    result = await cached_result(compute_diet, input, request)
+    t = perf_counter()
+    menu = menu_response("normal", result, input.clinical_condition, None, days)
+    record_stage("menu", "generate", t)
+    return respond(menu, "menu")
+
+@app.post("/calculate-renal-diet/menu")
+async def calculate_renal_diet_menu(input: RenalDietInput, request: Request = None,
+                                    days: int = Query(7, ge=1, le=MENU_MAX_DAYS)):
+    result = await cached_result(compute_renal_diet, input, request, heavy=True)
+    t = perf_counter()
+    limits = (input.potassium_limit, input.sodium_limit, input.phosphate_limit)
+    menu = menu_response("renal", result, input.clinical_condition, limits, days)
+    record_stage("menu", "generate", t)
+    return respond(menu, "menu")
+
+# Bulk renal import
+# Streams a CSV (header row first) or NDJSON upload of RenalDietInput rows and
+# streams NDJSON results back row by row, so memory stays flat for any file
+# size. Invalid rows are reported inline and don't stop the stream.
+# An application/json upload is one RenalDietColumns object instead: it is
+# read whole and its rows go through the same per-row validation and NDJSON
+# stream.
+BULK_CSV_TYPES = ("text/csv", "application/csv")
+BULK_NDJSON_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl", "application/json-lines")
+BULK_COLUMNAR_TYPES = ("application/json",)
+
+def decode_line(line):
+    # (text, decode error or None); an undecodable line is returned with
+    # replacement characters so a CSV header still yields column names
+    try:
+        return line.decode("utf-8").rstrip("\r"), None
+    except UnicodeDecodeError as e:
+        return line.decode("utf-8", errors="replace").rstrip("\r"), f"Not valid UTF-8 at byte {e.start}: {e.reason}."
+
+async def iter_request_lines(request):
+    # Lines are decoded one at a time, so a stray non-UTF-8 row (e.g. from a
+    # cp1252 spreadsheet export) fails only that row
+    pending = b""
+    async for chunk in request.stream():
+        pending += chunk
+        lines = pending.split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            yield decode_line(line)
+    if pending:
+        yield decode_line(pending)
+
+async def iter_bulk_rows(request, csv_format):
+    # Yields (row number, dict of fields or None, parse error or None); blank lines are skipped
+    header = None
+    row = 0
+    async for line, error in iter_request_lines(request):
+        if not line.strip():
+            continue
+        if csv_format and header is None:
+            header = [name.strip() for name in next(csv.reader([line]))]
+            continue
+        row += 1
+        if error is not None:
+            yield row, None, error
+            continue
+        if csv_format:
+            values = next(csv.reader([line]))
+            if len(values) != len(header):
+                yield row, None, f"Expected {len(header)} columns, got {len(values)}."
+                continue
+            # Empty cells fall back to the model defaults
+            yield row, {k: v.strip() for k, v in zip(header, values) if v.strip() != ""}, None
+        else:
+            try:
+                fields = json.loads(line)
+            except ValueError as e:
+                yield row, None, f"Invalid JSON: {e}"
+                continue
+            if not isinstance(fields, dict):
+                yield row, None, "Expected a JSON object."
+                continue
+            yield row, fields, None
+
+class RequestStreamingResponse(StreamingResponse):
+    # StreamingResponse may listen for client disconnects on receive(), which
+    # would swallow the upload this response is still reading. Here the body
+    # iterator owns receive() and sees the disconnect itself.
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
+
+async def iter_column_rows(lists):
+    # Same (row number, fields, parse error) rows as iter_bulk_rows, from column_lists output
+    for index, values in enumerate(zip(*lists.values())):
+        yield index + 1, dict(zip(lists, values)), None
+
+@app.post("/calculate-renal-diet/bulk")
+async def calculate_renal_diet_bulk(request: Request):
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if content_type not in BULK_CSV_TYPES + BULK_NDJSON_TYPES + BULK_COLUMNAR_TYPES:
+        raise HTTPException(
+            status_code=415,
+            detail="Upload rows as text/csv (with a header row), application/x-ndjson, "
+                   "or columns as application/json."
+        )
+    csv_format = content_type in BULK_CSV_TYPES
+    lean = lean_requested(request)
+    if content_type in BULK_COLUMNAR_TYPES:
+        # Parsed and checked before the response starts, so a malformed body is a plain 422
+        rows = iter_column_rows(column_lists(await parse_columns(request, RenalDietColumns), RenalDietInput))
+    else:
+        rows = iter_bulk_rows(request, csv_format)
+
+    async def results():
+        async for row, fields, error in rows:
+            if error is None:
+                try:
+                    input = RenalDietInput(**fields)
+                except ValidationError as e:
+                    yield encode_json({
+                        "row": row, "success": False, "message": "Validation failed.",
+                        "errors": validation_errors(e)
+                    }) + b"\n"
+                    continue
+                result = await run_engine(compute_renal_diet, input)
+                yield encode_response(dict(row=row, **result), lean) + b"\n"
+            else:
+                yield encode_json({
+                    "row": row, "success": False, "message": "Could not parse row.",
+                    "errors": [{"loc": [], "msg": error}]
+                }) + b"\n"
+
+    return RequestStreamingResponse(results(), media_type="application/x-ndjson")
+
+# Reference data
+# The portion reference tables only change with a deploy. They are served here
+# with a strong ETag (the hash of their JSON, as in lean responses), so clients
+# revalidate with If-None-Match and get a 304 instead of the table. Bodies are
+# encoded and compressed once at import; brotli is used when the package is
+# installed, gzip otherwise.
+REFERENCE_MAX_AGE = int(os.environ.get("DIET_REFERENCE_MAX_AGE", 86400))  # seconds
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Preferred first; identity is always available
+REFERENCE_ENCODINGS = ("br", "gzip", "identity")
+
+class ReferenceDocument:
+    def __init__(self, value):
+        body = encode_json(value)
+        self.bodies = {"identity": body, "gzip": gzip.compress(body, 9, mtime=0)}
+        if brotli is not None:
+            self.bodies["br"] = brotli.compress(body, quality=11)
+        # Each encoding is a different representation, so it gets its own tag
+        etag = strong_etag(body)
+        self.etags = {
+            encoding: etag if encoding == "identity" else etag[:-1] + "-" + encoding + '"'
+            for encoding in self.bodies
+        }
+
+REFERENCE_DOCUMENTS = {
+    "portions": ReferenceDocument(PORTION_REFERENCES),
+    "renal-portions": ReferenceDocument(RENAL_PORTION_REFERENCES),
+}
+
+def accepted_encoding(header, available):
+    # First coding in our preference order that the client accepts with q > 0;
+    # codings it doesn't list are acceptable only through "*"
+    weights = {}
+    for part in header.split(","):
+        coding, _, params = part.partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[coding.strip().lower()] = q
+    for coding in REFERENCE_ENCODINGS:
+        if coding in available and weights.get(coding, weights.get("*", 0.0)) > 0:
+            return coding
+    return "identity"
+
+def etag_matches(header, etags):
+    # If-None-Match uses weak comparison, and "*" matches any representation
+    tags = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    return "*" in tags or not tags.isdisjoint(etags.values())
+
+def reference_response(document, request):
+    encoding = accepted_encoding(request.headers.get("accept-encoding", ""), document.bodies)
+    headers = {
+        "ETag": document.etags[encoding],
+        "Cache-Control": f"public, max-age={REFERENCE_MAX_AGE}",
+        "Vary": "Accept-Encoding",
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag_matches(if_none_match, document.etags):
+        return Response(status_code=304, headers=headers)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(document.bodies[encoding], media_type="application/json", headers=headers)
+
+@app.get("/references/portions")
+async def read_portion_references(request: Request):
+    return reference_response(REFERENCE_DOCUMENTS["portions"], request)
+
+@app.get("/references/renal-portions")
+async def read_renal_portion_references(request: Request):
+    return reference_response(REFERENCE_DOCUMENTS["renal-portions"], request)
@@ -0,0 +1,41 @@
+"""Build the renal feasibility index (data/renal_index.npz).
+
+Solves every standard K/PO4/Na tier x macro band in main.RENAL_INDEX_TIERS and
+main.RENAL_INDEX_BANDS with the live solver, one tier per process. Rebuild
+after changing RENAL_FOOD_GROUPS or RENAL_MAX_SERVINGS; the server ignores an
+index solved for a different group table.
+
+Run from the repository root:
+
+    python scripts/build_renal_index.py
+    python scripts/build_renal_index.py --time-budget 0.2 --processes 8
+"""
+import argparse
+import os
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output", default=main.RENAL_INDEX_PATH)
+    parser.add_argument("--time-budget", type=float, default=main.RENAL_SOLVER_TIME_BUDGET,
+                        help="solver seconds per tier x band")
+    parser.add_argument("--processes", type=int, help="worker processes (default: CPU count)")
+    return parser.parse_args(argv)
+
+
+def run(argv=None):
+    args = parse_args(argv)
+    started = perf_counter()
+    main.build_renal_index(args.output, args.time_budget, args.processes)
+    print(f"Renal index written to {args.output} in {perf_counter() - started:.0f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
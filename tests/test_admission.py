@@ -0,0 +1,158 @@
+"""Admission control: lane limits, shedding, priority and permit accounting."""
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+ADULT = {"age": 30, "sex": "male", "weight": 70, "height": 175, "activity_factor": 1.3,
+         "stress_factor": 1.2, "carbs_percent": 50, "protein_percent": 20, "fats_percent": 30}
+
+
+def controller(concurrency=2, clinical=(2, 2, 0.5), public=(1, 1, 0.5)):
+    lanes = [main.AdmissionLane("clinical", *clinical), main.AdmissionLane("public", *public)]
+    return main.AdmissionController(concurrency, lanes), lanes[0], lanes[1]
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_lane_limit_queues_until_release():
+    async def scenario():
+        gate, _, public = controller()
+        await gate.acquire(public)
+        waiter = asyncio.ensure_future(gate.acquire(public))
+        await asyncio.sleep(0.01)
+        assert not waiter.done() and len(public.waiters) == 1
+        gate.release(public)
+        await waiter
+        assert public.active == 1 and gate.active == 1
+    run(scenario())
+
+
+def test_full_queue_is_shed_with_429():
+    async def scenario():
+        gate, _, public = controller()
+        await gate.acquire(public)
+        queued = asyncio.ensure_future(gate.acquire(public))
+        await asyncio.sleep(0.01)
+        with pytest.raises(main.AdmissionRejected) as rejected:
+            await gate.acquire(public)
+        assert rejected.value.status == 429
+        gate.release(public)
+        await queued
+    run(scenario())
+
+
+def test_own_wait_and_stale_head_are_shed_with_503():
+    async def scenario():
+        gate, _, public = controller(public=(1, 5, 0.05))
+        await gate.acquire(public)
+        head = asyncio.ensure_future(gate.acquire(public))
+        await asyncio.sleep(0.08)  # the head has now waited longer than max_wait
+        with pytest.raises(main.AdmissionRejected) as stale:
+            await gate.acquire(public)
+        assert stale.value.status == 503
+        with pytest.raises(main.AdmissionRejected) as timed_out:
+            await head
+        assert timed_out.value.status == 503
+        assert not public.waiters and public.active == 1
+    run(scenario())
+
+
+def test_clinical_waiters_go_first():
+    async def scenario():
+        gate, clinical, public = controller(concurrency=1)
+        await gate.acquire(clinical)
+        public_waiter = asyncio.ensure_future(gate.acquire(public))
+        await asyncio.sleep(0.01)
+        clinical_waiter = asyncio.ensure_future(gate.acquire(clinical))
+        await asyncio.sleep(0.01)
+        gate.release(clinical)
+        await clinical_waiter
+        assert not public_waiter.done()
+        gate.release(clinical)
+        await public_waiter
+        gate.release(public)
+        assert gate.active == clinical.active == public.active == 0
+    run(scenario())
+
+
+def test_cancelled_waiter_leaves_no_permit_behind():
+    async def scenario():
+        gate, _, public = controller()
+        await gate.acquire(public)
+        waiter = asyncio.ensure_future(gate.acquire(public))
+        await asyncio.sleep(0.01)
+        waiter.cancel()  # client gone while queued
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert not public.waiters
+        gate.release(public)
+        assert gate.active == public.active == 0
+    run(scenario())
+
+
+def test_cancelled_after_handover_gives_the_permit_back():
+    async def scenario():
+        gate, _, public = controller()
+        await gate.acquire(public)
+        waiter = asyncio.ensure_future(gate.acquire(public))
+        await asyncio.sleep(0.01)
+        gate.release(public)  # slot handed to the waiter...
+        waiter.cancel()  # ...which is cancelled before it resumes
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert gate.active == public.active == 0
+    run(scenario())
+
+
+@pytest.fixture
+def gate(monkeypatch):
+    admission, clinical, public = controller()
+    monkeypatch.setattr(main, "ADMISSION", admission)
+    monkeypatch.setattr(main, "ADMISSION_LANE", {"clinical": clinical, "public": public})
+    return admission
+
+
+def test_shed_response_carries_cors_and_retry_after(gate):
+    for lane in gate.lanes:
+        lane.concurrency = lane.queue_size = 0
+    client = TestClient(main.app)
+    response = client.post("/calculate-normal-metabolic-diet", json=ADULT, headers={"origin": "https://clinic.example"})
+    assert response.status_code == 429
+    assert response.headers["retry-after"] == main.ADMISSION_RETRY_AFTER
+    assert response.headers["access-control-allow-origin"] == "https://clinic.example"
+
+
+def test_reads_bypass_the_gate(gate):
+    for lane in gate.lanes:
+        lane.concurrency = lane.queue_size = 0
+    client = TestClient(main.app)
+    assert client.get("/references/portions").status_code == 200
+    assert client.get("/cache/stats").status_code == 200
+
+
+def call_middleware(inner, path="/calculate-normal-metabolic-diet"):
+    scope = {"type": "http", "method": "POST", "path": path, "headers": []}
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        pass
+
+    return main.AdmissionMiddleware(inner)(scope, receive, send)
+
+
+@pytest.mark.parametrize("failure", [RuntimeError("route failed"), asyncio.CancelledError()])
+def test_permit_released_when_the_request_fails_or_disconnects(gate, failure):
+    async def inner(scope, receive, send):
+        assert gate.active == 1
+        raise failure
+
+    with pytest.raises(type(failure)):
+        run(call_middleware(inner))
+    assert gate.active == 0 and all(lane.active == 0 for lane in gate.lanes)
@@ -0,0 +1,51 @@
+"""Streaming bulk import: bad rows are reported inline and the stream carries on."""
+import asyncio
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+HEADER = "age,sex,weight,height,activity_factor,stress_factor,carbs_percent,protein_percent,fats_percent,clinical_condition"
+ROW = "60,male,70,175,1.2,1.0,55,15,30,{}"
+
+
+@pytest.fixture(scope="module")
+def client():
+    return TestClient(main.app)
+
+
+def bulk(client, body, content_type):
+    response = client.post("/calculate-renal-diet/bulk", content=body, headers={"content-type": content_type})
+    assert response.status_code == 200, response.text
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+def test_csv_row_that_is_not_utf8(client):
+    body = "\n".join([HEADER, ROW.format("biguanides"), ROW.format("café"), ROW.format("")]).encode("cp1252")
+    rows = bulk(client, body, "text/csv")
+    assert [row["row"] for row in rows] == [1, 2, 3]
+    assert [row["success"] for row in rows] == [True, False, True]
+    assert "UTF-8" in rows[1]["errors"][0]["msg"]
+
+
+def test_ndjson_row_that_is_not_utf8(client):
+    record = json.dumps(dict(zip(HEADER.split(","), ROW.format("").split(","))), ensure_ascii=False)
+    lines = [record.encode("utf-8"), record.replace("male", "m\xe4le").encode("cp1252"), record.encode("utf-8")]
+    rows = bulk(client, b"\n".join(lines), "application/x-ndjson")
+    assert [row["success"] for row in rows] == [True, False, True]
+    assert rows[1]["message"] == "Could not parse row."
+
+
+def test_lines_split_across_chunks():
+    class Request:
+        async def stream(self):
+            data = "aéb\r\nc\n\nd".encode("utf-8")
+            for i in range(len(data)):
+                yield data[i:i + 1]
+
+    async def collect():
+        return [line async for line in main.iter_request_lines(Request())]
+
+    assert asyncio.run(collect()) == [("aéb", None), ("c", None), ("", None), ("d", None)]
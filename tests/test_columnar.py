@@ -0,0 +1,93 @@
+"""Columnar batch input accepts and rejects the same patients as the per-record routes."""
+import csv
+import io
+import json
+import random
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+FIELDS = ("age", "sex", "weight", "height", "activity_factor", "stress_factor",
+          "carbs_percent", "protein_percent", "fats_percent", "clinical_condition")
+
+
+@pytest.fixture(scope="module")
+def client():
+    return TestClient(main.app)
+
+
+def patients(seed, count):
+    rng = random.Random(seed)
+    return [{
+        "age": rng.randint(1, 90),
+        "sex": rng.choice(["male", "female", "Female"]),
+        "weight": round(rng.uniform(8, 120), 1),
+        "height": round(rng.uniform(70, 195), 1),
+        "activity_factor": rng.choice([1.2, 1.5]),
+        "stress_factor": rng.choice([1.0, 1.3]),
+        "carbs_percent": rng.choice([45, 50, 60]),  # sums need not be 100, as on the record path
+        "protein_percent": 20,
+        "fats_percent": 30,
+        "clinical_condition": rng.choice([None, "burn", "biguanides"]),
+    } for _ in range(count)]
+
+
+def columns(records, fields=FIELDS):
+    return {name: [record.get(name) for record in records] for name in fields}
+
+
+def test_columns_match_records(client):
+    records = patients(0, 40)
+    by_record = client.post("/calculate-normal-metabolic-diet/batch", json=records)
+    by_column = client.post("/calculate-normal-metabolic-diet/batch/columns", json=columns(records))
+    assert by_record.status_code == by_column.status_code == 200
+    assert by_record.json() == by_column.json()
+
+
+@pytest.mark.parametrize("field, value", [("weight", None), ("age", "x"), ("height", "tall"), ("sex", None)])
+def test_columns_reject_what_records_reject(client, field, value):
+    records = patients(1, 3)
+    records[1][field] = value
+    by_record = client.post("/calculate-normal-metabolic-diet/batch", json=records)
+    by_column = client.post("/calculate-normal-metabolic-diet/batch/columns", json=columns(records))
+    assert by_record.status_code == by_column.status_code == 422
+
+
+def bulk(client, body, content_type):
+    response = client.post("/calculate-renal-diet/bulk", content=body, headers={"content-type": content_type})
+    assert response.status_code == 200, response.text
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+def test_bulk_null_limits_take_the_defaults(client):
+    records = patients(2, 5)
+    limits = ("potassium_limit", "phosphate_limit", "sodium_limit")
+    for record in records:
+        record.update(dict.fromkeys(limits))
+    by_column = bulk(client, json.dumps(columns(records, FIELDS + limits)), "application/json")
+
+    text = io.StringIO()
+    writer = csv.writer(text)
+    writer.writerow(FIELDS + limits)
+    for record in records:
+        writer.writerow(["" if record[name] is None else record[name] for name in FIELDS + limits])
+    by_csv = bulk(client, text.getvalue(), "text/csv")
+
+    assert by_column == by_csv
+    for row in by_column:
+        totals = row["data"]["electrolyte_totals"]
+        assert totals["k"] <= 2000 and totals["po4"] <= 1000 and totals["na"] <= 2000
+
+
+def test_bulk_columns_check_types_and_keep_given_limits(client):
+    records = patients(3, 3)
+    body = columns(records)
+    body["weight"][1] = "heavy"
+    assert client.post("/calculate-renal-diet/bulk", json=body).status_code == 422
+    body = columns(records, FIELDS + ("potassium_limit",))
+    body["potassium_limit"] = [1500, None, 2500]
+    rows = bulk(client, json.dumps(body), "application/json")
+    assert [row["row"] for row in rows] == [1, 2, 3]
+    assert [row["data"]["electrolyte_totals"]["k"] <= limit for row, limit in zip(rows, (1500, 2000, 2500))] == [True] * 3
@@ -0,0 +1,61 @@
+"""Calculation engine: pool slots are given back however a calculation ends."""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    # A thread pool stands in for the process pool; run_engine treats them alike
+    executor = ThreadPoolExecutor(2)
+    monkeypatch.setattr(main, "engine_pool", lambda: executor)
+    monkeypatch.setattr(main, "ENGINE_MAX_QUEUE", 1)
+    yield executor
+    executor.shutdown(wait=True)
+
+
+def assert_idle():
+    assert main.ENGINE["inflight"] == 0 and main.ENGINE["waiting"] == 0
+    assert main.ENGINE["slots"]._value == main.ENGINE_MAX_QUEUE
+
+
+def fail():
+    raise ValueError("bad input")
+
+
+def test_slot_released_when_the_calculation_raises(pool):
+    async def scenario():
+        with pytest.raises(ValueError):
+            await main.run_engine(fail)
+        assert_idle()
+        assert await main.run_engine(sum, [1, 2]) == 3
+        assert_idle()
+    asyncio.run(scenario())
+
+
+def test_slot_released_when_the_client_disconnects(pool):
+    started, finish = threading.Event(), threading.Event()
+
+    def blocking():
+        started.set()
+        finish.wait(5)
+        return "done"
+
+    async def scenario():
+        running = asyncio.ensure_future(main.run_engine(blocking))
+        while not started.is_set():
+            await asyncio.sleep(0.01)
+        waiting = asyncio.ensure_future(main.run_engine(sum, [1]))
+        await asyncio.sleep(0.01)
+        assert main.ENGINE["waiting"] == 1
+        waiting.cancel()  # disconnected while waiting for a slot
+        running.cancel()  # disconnected while its calculation runs
+        await asyncio.gather(running, waiting, return_exceptions=True)
+        finish.set()
+        assert_idle()
+        assert await main.run_engine(sum, [1, 2]) == 3
+    asyncio.run(scenario())
@@ -0,0 +1,104 @@
+"""Plan history: write-behind flush on shutdown, writer failures and reading plans back."""
+import sqlite3
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+PATIENT = dict(
+    age=45, sex="female", weight=68.5, height=165, activity_factor=1.3, stress_factor=1.0,
+    carbs_percent=50, protein_percent=20, fats_percent=30,
+)
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = main.HistoryStore(str(tmp_path / "history.db"), 2, 100)
+    yield store
+    if store.writer.is_alive():
+        store.close()
+
+
+def rows(store):
+    with sqlite3.connect(store.path) as db:
+        return db.execute("SELECT patient_id, calculation FROM plans ORDER BY id").fetchall()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "history writer did not catch up"
+        time.sleep(0.01)
+
+
+def test_close_flushes_queued_records(store, monkeypatch):
+    # A long flush interval keeps everything queued until close()
+    monkeypatch.setattr(main, "HISTORY_FLUSH_INTERVAL", 60)
+    input = main.DietInput(**PATIENT)
+    for i in range(5):
+        store.record(f"p{i}", "diet", input, {"success": True, "data": {"i": i}})
+    store.close()
+    assert not store.writer.is_alive()
+    assert rows(store) == [(f"p{i}", "diet") for i in range(5)]
+    assert store.stats() == {"queued": 0, "written": 5, "dropped": 0, "failed": 0}
+
+
+def test_unencodable_record_fails_alone(store):
+    input = main.DietInput(**PATIENT)
+    store.record("p1", "diet", input, {"data": {"value": float("nan")}})
+    store.record("p2", "diet", input, {"data": {"value": 1.0}})
+    store.close()
+    assert rows(store) == [("p2", "diet")]
+    assert store.stats()["failed"] == 1 and store.stats()["written"] == 1
+
+
+def test_writer_survives_a_rejected_batch(store):
+    input = main.DietInput(**PATIENT)
+    # patient_id is NOT NULL, so the database rejects this batch
+    store.record(None, "diet", input, {"data": {}})
+    wait_for(lambda: store.stats()["failed"] == 1)
+    assert store.writer.is_alive()
+    store.record("p1", "renal", input, {"data": {}})
+    store.close()
+    assert rows(store) == [("p1", "renal")]
+    assert store.stats()["written"] == 1
+
+
+def test_plans_read_back_newest_first_with_filters(store):
+    input = main.DietInput(**PATIENT)
+    for calculation in ("diet", "renal", "diet"):
+        store.record("p1", calculation, input, {"calculation": calculation})
+    store.record("p2", "diet", input, {})
+    wait_for(lambda: store.stats()["written"] == 4)
+    plans = store.plans("p1", 0.0, float("inf"), None, None, 10)
+    assert [plan[2] for plan in plans] == ["diet", "renal", "diet"]
+    assert [plan[0] for plan in plans] == sorted((plan[0] for plan in plans), reverse=True)
+    assert len(store.plans("p1", 0.0, float("inf"), "renal", None, 10)) == 1
+    # Paging continues after the (created_at, id) of the previous page's last row
+    first = store.plans("p1", 0.0, float("inf"), None, None, 2)
+    rest = store.plans("p1", 0.0, float("inf"), None, (first[-1][1], first[-1][0]), 2)
+    assert [plan[0] for plan in first + rest] == [plan[0] for plan in plans]
+
+
+def test_route_reads_back_plans_recorded_before_shutdown(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "HISTORY_DB", str(tmp_path / "history.db"))
+    main.RESULT_CACHE.clear()
+    with TestClient(main.app) as client:
+        calculated = client.post(
+            "/calculate-normal-metabolic-diet", json=PATIENT, headers={main.PATIENT_ID_HEADER: "p-42"}
+        ).json()
+        client.post("/calculate-normal-metabolic-diet", json=PATIENT)  # no patient id: not recorded
+    assert main.HISTORY is None
+    with TestClient(main.app) as client:
+        body = client.get("/patients/p-42/plans").json()
+        assert body["count"] == 1
+        plan = body["plans"][0]
+        assert plan["calculation"] == "diet"
+        assert plan["input"]["weight"] == PATIENT["weight"]
+        assert plan["result"] == calculated
+        assert client.get("/patients/nobody/plans").json()["count"] == 0
+    monkeypatch.setattr(main, "HISTORY_DB", "")
+    with TestClient(main.app) as client:
+        assert client.get("/patients/p-42/plans").status_code == 503
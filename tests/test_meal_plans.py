@@ -0,0 +1,78 @@
+"""Per-meal apportionment invariants and renal meal plans against the prescribed limits."""
+import random
+
+import numpy as np
+import pytest
+
+import main
+
+TABLES = {
+    "normal": main.FOOD_GROUP_MATRIX,
+    "renal": main.RENAL_FOOD_GROUP_MATRIX,
+}
+
+
+@pytest.mark.parametrize("table", sorted(TABLES))
+def test_apportionment_keeps_totals_and_shares(table):
+    matrix = TABLES[table]
+    rng = np.random.default_rng(0)
+    for _ in range(1500):
+        servings = rng.integers(0, 15, size=len(matrix))
+        plan = main.apportion_servings(servings, matrix, main.MEDICATION_MATRIX)
+        assert plan.shape == (len(main.MEDICATION_MATRIX), len(matrix), main.MEDICATION_MATRIX.shape[1])
+        assert (plan >= 0).all()
+        # Every serving is placed exactly once
+        assert (plan.sum(axis=2) == servings).all()
+        # No meal is more than one serving off its share: each gets floor or ceil of its quota
+        quota = servings[None, :, None] * main.MEDICATION_MATRIX[:, None, :]
+        assert (plan >= np.floor(quota + 1e-9)).all()
+        assert (plan <= np.ceil(quota - 1e-9)).all()
+
+
+def test_single_regimen_matches_all_regimens():
+    # The menu path apportions one regimen at a time
+    rng = np.random.default_rng(1)
+    for _ in range(200):
+        servings = rng.integers(0, 15, size=len(main.FOOD_GROUP_MATRIX))
+        plans = main.apportion_servings(servings, main.FOOD_GROUP_MATRIX, main.MEDICATION_MATRIX)
+        for regimen in range(len(main.MEDICATION_MATRIX)):
+            single = main.apportion_servings(
+                servings, main.FOOD_GROUP_MATRIX, main.MEDICATION_MATRIX[regimen:regimen + 1]
+            )
+            assert (single[0] == plans[regimen]).all()
+
+
+def renal_plan_electrolytes(plan):
+    # (K, Na, PO4) of a meal_plan: named foods from the food database, group-level items by group content
+    foods = {}
+    for group, index in main.FOOD_DB.indexes["renal"].items():
+        for food in index["ids"].tolist():
+            foods[(group, main.FOOD_DB.names[food])] = main.FOOD_DB.electrolytes[food]
+    groups = dict(zip(main.RENAL_FOOD_GROUP_NAMES, main.RENAL_FOOD_GROUP_MATRIX[:, 4:].astype(float)))
+    totals = np.zeros(len(main.FOOD_ELECTROLYTES))
+    for items in plan.values():
+        for item in items:
+            content = foods.get((item["group"], item["food"]))
+            totals += item["servings"] * (groups[item["group"]] if content is None else content)
+    return totals
+
+
+@pytest.mark.skipif(main.FOOD_DB is None, reason="no food database")
+def test_renal_meal_plan_stays_within_limits():
+    rng = random.Random(0)
+    for _ in range(300):
+        limits = {"potassium_limit": rng.choice([1500, 2000, 2500, 3000]),
+                  "sodium_limit": rng.choice([1500, 2000, 2300]),
+                  "phosphate_limit": rng.choice([800, 1000, 1200])}
+        input = main.RenalDietInput(
+            age=rng.randint(19, 85), sex=rng.choice(["male", "female"]), weight=round(rng.uniform(45, 120), 1),
+            height=round(rng.uniform(150, 195), 1), activity_factor=rng.choice([1.2, 1.3, 1.5]),
+            stress_factor=rng.choice([1.0, 1.2, 1.4]), carbs_percent=55, protein_percent=15, fats_percent=30,
+            clinical_condition=rng.choice([None, "biguanides", "fast acting", "sulfonylureas"]), **limits
+        )
+        data = main.compute_renal_diet(input)["data"]
+        allowed = np.array([limits["potassium_limit"], limits["sodium_limit"], limits["phosphate_limit"]])
+        servings = data["electrolyte_totals"]
+        if servings["k"] > allowed[0] or servings["na"] > allowed[1] or servings["po4"] > allowed[2]:
+            continue  # infeasible prescription: the solver's own totals are over
+        assert (renal_plan_electrolytes(data["meal_plan"]) <= allowed + 1e-6).all(), limits
@@ -0,0 +1,105 @@
+"""Renal serving allocation: electrolyte limits, greedy seed and infeasible prescriptions."""
+import random
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+GROUPS = main.RENAL_SOLVER_GROUPS
+
+
+def totals(counts):
+    # (carb, protein, fat, k, po4, na) for a serving vector
+    return [sum(s * g[x] for s, g in zip(counts, GROUPS)) for x in range(6)]
+
+
+def residual(counts, target):
+    achieved = totals(counts)
+    return sum(abs(target[m] - achieved[m]) for m in range(3))
+
+
+def within_limits(counts, limits):
+    used = totals(counts)[3:]
+    return all(limit is None or used[e] <= limit for e, limit in enumerate(limits))
+
+
+def greedy_counts(target, limits):
+    greedy, _ = main.greedy_renal_servings(*target, *(float("inf") if v is None else v for v in limits))
+    return [greedy[g["name"]] for g in main.RENAL_FOOD_GROUPS]
+
+
+def prescriptions(seed, count):
+    rng = random.Random(seed)
+    for _ in range(count):
+        target = (rng.randint(100, 450), rng.randint(30, 150), rng.randint(30, 120))
+        limits = (
+            rng.choice([None, 800, 1500, 2000, 2500, 3000]),
+            rng.choice([None, 300, 800, 1000, 1200]),
+            rng.choice([None, 500, 1500, 2000, 2300]),
+        )
+        yield target, limits
+
+
+@pytest.mark.parametrize("target, limits", list(prescriptions(0, 40)))
+def test_solver_stays_within_limits_and_beats_greedy(target, limits):
+    counts = main.solve_renal_servings(*target, *limits, time_budget=0.01)
+    assert len(counts) == len(GROUPS)
+    assert all(0 <= s <= main.RENAL_MAX_SERVINGS for s in counts)
+    assert within_limits(counts, limits)
+    assert residual(counts, target) <= residual(greedy_counts(target, limits), target)
+
+
+def test_refinement_never_leaves_limits_or_gets_worse():
+    for target, limits in prescriptions(1, 100):
+        seed = greedy_counts(target, limits)
+        counts = main.refine_renal_servings(seed, *target, *limits)
+        assert within_limits(counts, limits)
+        assert residual(counts, target) <= residual(seed, target)
+
+
+@pytest.mark.skipif(main.RENAL_INDEX is None, reason="no current renal index file")
+def test_indexed_allocation_stays_within_tier_limits():
+    rng = random.Random(2)
+    for _ in range(100):
+        target = (rng.randint(100, 450), rng.randint(30, 150), rng.randint(30, 120))
+        limits = tuple(rng.choice(tiers) for tiers in main.RENAL_INDEX_TIERS.values())
+        counts = main.indexed_renal_allocation(*target, *limits)
+        assert counts is not None
+        assert within_limits(counts, limits)
+
+
+def test_fractional_limits_are_never_exceeded():
+    main.cached_renal_allocation.cache_clear()
+    rng = random.Random(3)
+    for _ in range(30):
+        target = (rng.uniform(100, 450), rng.uniform(30, 150), rng.uniform(30, 120))
+        limits = (rng.uniform(800, 3000), rng.uniform(300, 1200), rng.uniform(500, 2300))
+        _, electrolytes = main.auto_renal_servings(*target, *limits)
+        assert all(electrolytes[e] <= limit for e, limit in zip(main.RENAL_ELECTROLYTES, limits))
+
+
+@pytest.mark.parametrize("limits", [(0, 0, 0), (1, 1, 1), (0, None, None)])
+def test_infeasible_limits_fall_back_to_allowed_groups(limits):
+    # No serving of an electrolyte-bearing group fits: the solver still returns
+    # an allocation, built only from groups the limits allow
+    target = (300, 80, 70)
+    counts = main.solve_renal_servings(*target, *limits, time_budget=0.01)
+    assert within_limits(counts, limits)
+    assert any(counts)
+    assert residual(counts, target) <= residual(greedy_counts(target, limits), target)
+
+
+def test_infeasible_renal_request_reports_shortfall():
+    body = dict(
+        age=50, sex="male", weight=70, height=170, activity_factor=1.3, stress_factor=1.0,
+        carbs_percent=55, protein_percent=15, fats_percent=30,
+        potassium_limit=0, phosphate_limit=0, sodium_limit=0,
+    )
+    client = TestClient(main.app)
+    response = client.post("/calculate-renal-diet", json=body, headers={main.CACHE_BYPASS_HEADER: "1"})
+    assert response.status_code == 200
+    data = response.json()["data"]
+    assert data["electrolyte_totals"] == {"k": 0, "po4": 0, "na": 0}
+    # Every protein group carries electrolytes, so the whole target is unmet
+    assert data["residuals"]["protein_g"] == data["macronutrients"]["protein_g"]
@@ -0,0 +1,128 @@
+"""Result cache: canonical input keys, TTL expiry, LRU eviction and the bypass headers."""
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+PATIENT = dict(
+    age=45, sex="female", weight=68.5, height=165, activity_factor=1.3, stress_factor=1.0,
+    carbs_percent=50, protein_percent=20, fats_percent=30,
+)
+
+
+def key(**changes):
+    return main.canonical_input_key(main.DietInput(**dict(PATIENT, **changes)))
+
+
+def test_key_ignores_field_order():
+    reordered = dict(reversed(list(PATIENT.items())))
+    assert main.canonical_input_key(main.DietInput(**reordered)) == key()
+
+
+def test_key_normalises_numbers():
+    # Ints and floats for float fields, sub-micro noise and negative zero all match
+    assert key(height=165.0) == key(height=165)
+    assert key(weight=68.5000000001) == key(weight=68.5)
+    assert key(bmr_override=-0.0) == key(bmr_override=0.0)
+    assert key(weight=68.501) != key(weight=68.5)
+
+
+def test_key_normalises_sex_and_defaults():
+    assert key(sex="Female") == key(sex="FEMALE") == key()
+    # An explicit default is the same input as an omitted one
+    assert key(caloric_target=None, clinical_condition=None) == key()
+
+
+def test_key_separates_input_models():
+    renal = main.RenalDietInput(**PATIENT)
+    assert main.canonical_input_key(renal) != key()
+    assert main.canonical_input_key(renal)[0] == "RenalDietInput"
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main, "monotonic", lambda: now[0])
+    return now
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = main.ResultCache(4, ttl=10)
+    cache.put("a", 1)
+    clock[0] += 9.5
+    assert cache.get("a") == 1
+    clock[0] += 1
+    assert cache.get("a") is None
+    stats = cache.stats()
+    assert stats["expirations"] == 1 and stats["size"] == 0
+    assert stats["hits"] == 1 and stats["misses"] == 1
+
+
+def test_put_refreshes_ttl(clock):
+    cache = main.ResultCache(4, ttl=10)
+    cache.put("a", 1)
+    clock[0] += 8
+    cache.put("a", 2)
+    clock[0] += 8
+    assert cache.get("a") == 2
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = main.ResultCache(2, ttl=60)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1  # "b" is now the oldest
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+
+
+def test_zero_size_cache_stores_nothing():
+    cache = main.ResultCache(0, ttl=60)
+    cache.put("a", 1)
+    assert cache.get("a") is None
+    assert cache.stats()["size"] == 0
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(main, "shared_cache", lambda: None)
+    main.RESULT_CACHE.clear()
+    yield TestClient(main.app)
+    main.RESULT_CACHE.clear()
+
+
+def lookups():
+    stats = main.RESULT_CACHE.stats()
+    return stats["hits"], stats["misses"]
+
+
+def test_repeated_request_is_a_hit(client):
+    first = client.post("/calculate-normal-metabolic-diet", json=PATIENT).json()
+    hits, misses = lookups()
+    again = client.post("/calculate-normal-metabolic-diet", json=dict(PATIENT, sex="FEMALE")).json()
+    assert again == first
+    assert lookups() == (hits + 1, misses)
+
+
+@pytest.mark.parametrize("headers", [
+    {main.CACHE_BYPASS_HEADER: "1"},
+    {main.CACHE_BYPASS_HEADER: "true"},
+    {"cache-control": "no-cache"},
+])
+def test_bypass_headers_skip_the_lookup(client, headers):
+    first = client.post("/calculate-normal-metabolic-diet", json=PATIENT).json()
+    hits, misses = lookups()
+    bypassed = client.post("/calculate-normal-metabolic-diet", json=PATIENT, headers=headers).json()
+    assert bypassed == first
+    # Recomputed without a lookup; the fresh result still replaces the entry
+    assert lookups() == (hits, misses)
+    assert main.RESULT_CACHE.stats()["size"] == 1
+
+
+def test_other_header_values_do_not_bypass(client):
+    client.post("/calculate-normal-metabolic-diet", json=PATIENT)
+    hits, misses = lookups()
+    client.post("/calculate-normal-metabolic-diet", json=PATIENT, headers={main.CACHE_BYPASS_HEADER: "0"})
+    assert lookups() == (hits + 1, misses)
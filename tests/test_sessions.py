@@ -0,0 +1,64 @@
+"""Recalculation sessions: a PATCH must give the same data as a full compute_diet.
+
+Guards SESSION_STAGES: a missing dependency leaves a stale value in the
+session, which these random edit sequences catch.
+"""
+import json
+import random
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+PATIENT = {"age": 30, "sex": "male", "weight": 70, "height": 175, "activity_factor": 1.3,
+           "stress_factor": 1.2, "carbs_percent": 50, "protein_percent": 20, "fats_percent": 30}
+EDITS = {
+    # field: values an edit picks from
+    "age": [1, 5, 12, 30, 60, 85],
+    "sex": ["male", "female"],
+    "weight": [8, 15, 40, 70, 90],
+    "height": [80, 120, 160, 175, 190],
+    "activity_factor": [1.2, 1.3, 1.5],
+    "stress_factor": [1.0, 1.2, 1.4],
+    "carbs_percent": [45, 50, 55],
+    "protein_percent": [15, 20, 25],
+    "clinical_condition": [None, "burn", "biguanides", "fast acting", "sulfonylureas"],
+    "caloric_target": [None, 1800, 2200],
+    "bmr_override": [None, 1500],
+    "tbsa": [None, 10, 40],
+    "body_temp": [None, 37, 39],
+}
+
+
+def full_data(values):
+    return json.loads(main.respond(main.compute_diet(main.DietInput(**values))).body)["data"]
+
+
+@pytest.fixture(scope="module")
+def client():
+    return TestClient(main.app)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_patch_matches_full_calculation(client, seed):
+    rng = random.Random(seed)
+    created = client.post("/sessions", json=PATIENT).json()
+    session_id, data, values = created["session_id"], created["data"], dict(PATIENT)
+    assert data == full_data(values)
+    for _ in range(60):
+        fields = {name: rng.choice(EDITS[name]) for name in rng.sample(sorted(EDITS), rng.randint(1, 3))}
+        response = client.patch(f"/sessions/{session_id}", json=fields)
+        assert response.status_code == 200, response.text
+        values.update(fields)
+        data.update(response.json()["data"])
+        assert data == full_data(values), fields
+    assert client.get(f"/sessions/{session_id}").json()["data"] == data
+
+
+def test_unchanged_patch_recomputes_nothing(client):
+    session_id = client.post("/sessions", json=PATIENT).json()["session_id"]
+    patched = client.patch(f"/sessions/{session_id}", json={"weight": PATIENT["weight"]}).json()
+    assert patched["data"] == {}
+    assert patched["recomputed_stages"] == []
+    assert patched["version"] == 1
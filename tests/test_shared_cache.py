@@ -0,0 +1,139 @@
+"""Shared SQLite cache: concurrent writers, expiry and eviction, and unusable cache files."""
+import multiprocessing
+import sqlite3
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+PATIENT = dict(
+    age=45, sex="female", weight=68.5, height=165, activity_factor=1.3, stress_factor=1.0,
+    carbs_percent=50, protein_percent=20, fats_percent=30,
+)
+WRITES = 200
+
+
+def write_entries(path, worker):
+    # Runs in a separate process, as a uvicorn worker would
+    cache = main.SharedCache(path, 100000, 60, "test")
+    for i in range(WRITES):
+        cache.put((worker, i), {"worker": worker, "i": i})
+        cache.put(("shared",), {"worker": worker})
+    errors = cache.errors
+    cache.close()
+    return errors
+
+
+def test_concurrent_writers_keep_every_entry(tmp_path):
+    path = str(tmp_path / "shared.db")
+    main.SharedCache(path, 100000, 60, "test").close()  # create the schema up front
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(3) as pool:
+        errors = pool.starmap(write_entries, [(path, worker) for worker in range(3)])
+    assert errors == [0, 0, 0]
+    cache = main.SharedCache(path, 100000, 60, "test")
+    for worker in range(3):
+        for i in range(WRITES):
+            assert cache.get((worker, i)) == {"worker": worker, "i": i}
+    assert cache.get(("shared",))["worker"] in range(3)
+    assert cache.stats()["size"] == 3 * WRITES + 1
+    cache.close()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(main, "time", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = main.SharedCache(str(tmp_path / "shared.db"), 2, 10, "test")
+    yield cache
+    cache.close()
+
+
+def test_entries_expire_after_ttl(cache, clock):
+    cache.put("a", {"v": 1})
+    clock[0] += 9
+    assert cache.get("a") == {"v": 1}
+    clock[0] += 2
+    assert cache.get("a") is None
+    assert cache.stats()["misses"] == 1
+
+
+def test_trim_drops_expired_then_least_recently_used(cache, clock, monkeypatch):
+    monkeypatch.setattr(main, "SHARED_CACHE_TRIM_EVERY", 1)
+    cache.put("old", 1)
+    clock[0] += 11
+    cache.put("a", 1)  # trims "old", which has expired
+    assert cache.stats()["size"] == 1
+    clock[0] += 1
+    cache.put("b", 2)
+    clock[0] += 1
+    cache.put("c", 3)  # over maxsize 2: "a" was used least recently
+    assert cache.get("a") is None
+    assert cache.get("b") == 2 and cache.get("c") == 3
+
+
+def test_kinds_do_not_collide(cache):
+    cache.put("k", [1, 2], "renal_allocation")
+    assert cache.get("k") is None
+    assert cache.get("k", "renal_allocation") == [1, 2]
+
+
+def test_locked_file_counts_errors_and_keeps_serving(cache):
+    cache.put("a", {"v": 1})
+    cache.db.execute("PRAGMA busy_timeout = 50")
+    locker = sqlite3.connect(cache.db.execute("PRAGMA database_list").fetchone()[2], isolation_level=None)
+    locker.execute("BEGIN IMMEDIATE")
+    try:
+        cache.put("b", {"v": 2})
+        assert cache.stats()["errors"] == 1
+        # WAL readers aren't blocked by the writer
+        assert cache.get("a") == {"v": 1}
+    finally:
+        locker.execute("ROLLBACK")
+        locker.close()
+    cache.put("b", {"v": 2})
+    assert cache.get("b") == {"v": 2}
+
+
+@pytest.fixture
+def shared_path(tmp_path, monkeypatch):
+    path = tmp_path / "shared.db"
+    monkeypatch.setattr(main, "SHARED_CACHE_PATH", str(path))
+    monkeypatch.setitem(main.SHARED_CACHE_STATE, "cache", None)
+    monkeypatch.setitem(main.SHARED_CACHE_STATE, "pid", None)
+    main.RESULT_CACHE.clear()
+    yield path
+    main.close_shared_cache()
+    main.RESULT_CACHE.clear()
+
+
+def test_corrupt_file_falls_back_to_the_process_cache(shared_path):
+    shared_path.write_bytes(b"this is not a sqlite database" * 100)
+    assert main.shared_cache() is None
+    client = TestClient(main.app)
+    response = client.post("/calculate-normal-metabolic-diet", json=PATIENT)
+    assert response.status_code == 200
+    assert "shared" not in client.get("/cache/stats").json()["data"]
+
+
+def test_locked_file_does_not_fail_requests(shared_path):
+    cache = main.shared_cache()
+    cache.db.execute("PRAGMA busy_timeout = 50")
+    locker = sqlite3.connect(str(shared_path), isolation_level=None)
+    locker.execute("BEGIN IMMEDIATE")
+    try:
+        client = TestClient(main.app)
+        response = client.post("/calculate-normal-metabolic-diet", json=PATIENT)
+        assert response.status_code == 200
+        assert cache.stats()["errors"] == 1
+        # The in-memory cache still answers the repeat
+        assert client.post("/calculate-normal-metabolic-diet", json=PATIENT).json() == response.json()
+    finally:
+        locker.execute("ROLLBACK")
+        locker.close()